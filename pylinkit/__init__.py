@@ -1,72 +1,417 @@
-from .ble import BLEDevice
-from .dte import DTE
-from .ota_fw import OTAFW
+import asyncio
+import logging
+import re
+from .ble import AsyncBLEDevice, BLEDevice
+from .dte import AsyncDTE, DTE
+from .dte_nus import NUS_PIPELINE_DEPTH
+from .dte_params import DTEParamMap
+from .ota_fw import AsyncOTAFW, OTAFW, OTAInterrupted, OTA_WRITE_WINDOW
+from .dumpd import DUMPDCheckpoint
+from .log_cache import LogCache
+from .fw_cache import FirmwareCache
+from .registry import DeviceRegistry, IDENTITY_PARAMS
+from .param_cache import ParamCache, param_class, CONFIG, STATUS, STATUS_TTL
+
+
+logger = logging.getLogger(__name__)
+
+
+OTA_RECONNECT_DELAY = 2.0
+
+
+def _is_tracker(x):
+    return x.name and ('Linkit' in x.name or 'Horizon' in x.name)
+
+
+class AsyncScanner():
+    """Trackers found are recorded in registry (a DeviceRegistry) if given"""
+
+    def __init__(self, device=None, registry=None):
+        self._device = device or AsyncBLEDevice()
+        self._registry = registry
+
+    async def scan_stream(self, timeout=None, address=None, name=None, count=None):
+        """Yields trackers as their advertisements arrive, for at most timeout seconds.
+        Stops early once every wanted address (one or a list) has been found, or count
+        trackers have been found.  If name is given only trackers whose name matches that
+        regular expression are yielded.
+        """
+        wanted = set(x.upper() for x in ([address] if isinstance(address, str) else address or []))
+        pattern = re.compile(name) if name else None
+
+        def accept(x):
+            return _is_tracker(x) and (not wanted or x.address.upper() in wanted) and \
+                (pattern is None or pattern.search(x.name))
+
+        found = 0
+        stream = self._device.scan_stream(timeout, accept)
+        try:
+            async for x in stream:
+                if self._registry:
+                    self._registry.seen(x, self._device.rssi(x.address))
+                yield x
+                found += 1
+                wanted.discard(x.address.upper())
+                if (address and not wanted) or (count and found >= count):
+                    break
+        finally:
+            # Stop scanning now rather than when the stream is garbage collected
+            await stream.aclose()
+
+    async def scan(self, timeout=None, address=None, name=None, count=None, on_device=None):
+        """Returns the trackers found by scan_stream, calling on_device(x) for each as
+        soon as it is found
+        """
+        result = []
+        async for x in self.scan_stream(timeout, address, name, count):
+            if on_device:
+                on_device(x)
+            result.append(x)
+        return result
 
 
 class Scanner():
-    def __init__(self):
+    def __init__(self, registry=None):
         self._device = BLEDevice()
+        self._scanner = AsyncScanner(self._device.async_device, registry)
+
+    def scan(self, timeout=None, address=None, name=None, count=None, on_device=None):
+        """See AsyncScanner.scan, on_device is called from the BLE thread"""
+        return self._device._await_bleak(self._scanner.scan(timeout, address, name, count, on_device))
+
+
+class AsyncTracker():
+    """Tracker API running directly on the caller's event loop.
+
+    Call connect() (or use async with) before any other method.  If
+    write_without_response is set then DTE commands are written without response
+    (see AsyncDTENUS).  Up to pipeline_depth concurrent commands are pipelined.  Param values are cached (see ParamCache) and get() reads
+    only those that are stale, status params after status_ttl seconds.
+
+    If registry (a DeviceRegistry) is given then a device handle it holds is used to
+    connect and the tracker's identity params are recorded in it, as far as they can be
+    read.
+    """
+
+    def __init__(self, address, device=None, write_without_response=False, status_ttl=STATUS_TTL, registry=None,
+                 pipeline_depth=NUS_PIPELINE_DEPTH):
+        self._address = address
+        self._registry = registry
+        self._pipeline_depth = pipeline_depth
+        self._device = device or AsyncBLEDevice()
+        self._write_without_response = write_without_response
+        self._dte = AsyncDTE(self._device, write_without_response, pipeline_depth)
+        self._otafw = AsyncOTAFW(self._device)
+        self._cache = ParamCache(status_ttl)
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+    async def connect(self, timeout=5):
+        await self._connect(timeout)
+        if self._registry:
+            await self._identify()
+        return self
+
+    async def _identify(self):
+        """Reads the identity params and records them in the registry.  A full STATR
+        is used because a targeted read fails if the device lacks any one of the keys,
+        which must not stop the device from being used.
+        """
+        try:
+            self._cache.update(await self._dte.statr())
+            self._cache.update(await self._dte.parmr([p for p in IDENTITY_PARAMS if param_class(p) == CONFIG]))
+        except Exception as e:
+            logger.warning('%s: failed to read identity params: %s', self._address, e)
+        self._identified()
+
+    async def _connect(self, timeout):
+        handle = self._registry.handle(self._address) if self._registry else None
+        await self._device.connect(handle or self._address, timeout)
+
+    async def disconnect(self):
+        await self._device.disconnect()
+
+    async def reconnect(self, timeout=5):
+        """Re-establishes a dropped connection, subscriptions are made again on next use"""
+        try:
+            await self._device.disconnect()
+        except Exception as e:
+            logger.warning('Disconnect failed: %s', e)
+        await self._connect(timeout)
+        self._dte = AsyncDTE(self._device, self._write_without_response, self._pipeline_depth)
+        self._otafw.reset()
+
+    async def sync(self):
+        """Reads all params with a full PARMR and STATR"""
+        a, b = await asyncio.gather(self._dte.parmr(), self._dte.statr())
+        self._cache.update({ **a, **b }, complete=True)
+        self._identified()
+
+    async def refresh(self, params=None):
+        """Reads the given params (default: all) that are stale, configuration with a
+        targeted PARMR and status with a targeted STATR.
+        """
+        if params is None and not self._cache.complete:
+            return await self.sync()
+        stale = self._cache.stale(params)
+        config = [p for p in stale if param_class(p) == CONFIG]
+        status = [p for p in stale if param_class(p) != CONFIG]
+        reads = []
+        if config:
+            reads.append(self._dte.parmr(config))
+        if status:
+            reads.append(self._dte.statr(status))
+        for values in await asyncio.gather(*reads):
+            self._cache.update(values)
+        if any(p in IDENTITY_PARAMS for p in stale):
+            self._identified()
+
+    def _identified(self):
+        if self._registry:
+            self._registry.identified(self._address, self._cache.get())
+
+    async def set(self, param_values, diff=False):
+        """Writes param_values with PARMW.  If diff is set then only the params whose
+        encoded values differ from the device's (cached or freshly read) are written and
+        then verified.  Returns the params written.
+        """
+        if diff:
+            param_values = await self.changed(param_values)
+            if not param_values:
+                return {}
+        await self._dte.parmw(param_values=param_values)
+        self._cache.invalidate(list(param_values))
+        if diff:
+            mismatched = await self.verify(param_values)
+            if mismatched:
+                raise Exception('Verify failed for {}'.format(','.join(mismatched)))
+        return param_values
+
+    async def changed(self, param_values):
+        """Returns the subset of param_values whose encoded values differ from the device's"""
+        await self.refresh(list(param_values))
+        return {p: param_values[p] for p in param_values if not self._equal(p, param_values[p], self._cache.get(p))}
+
+    async def verify(self, param_values):
+        """Reads back param_values and returns the params whose encoded values differ"""
+        actual = await self._dte.parmr(list(param_values))
+        self._cache.update(actual)
+        return [p for p in param_values if not self._equal(p, param_values[p], actual[p])]
+
+    @staticmethod
+    def _equal(param, a, b):
+        return DTEParamMap.encode(param, a) == DTEParamMap.encode(param, b)
+
+    async def get(self, attr=None):
+        await self.refresh([attr] if attr else None)
+        return self._cache.get(attr)
 
-    def scan(self):
-        return [x for x in self._device.scan() if (x.name and ('Linkit' in x.name or 'Horizon' in x.name))]
+    def get_attrs(self):
+        return self._cache.keys()
+
+    async def firmware_update(self, data, file_id=0, timeout=None, write_without_response=False, window=OTA_WRITE_WINDOW,
+                              progress=None, retries=0, cache=None, resume=False):
+        """Sends a firmware image.  If the link drops during the transfer then up to retries
+        further attempts, each counting a failed reconnect, are made to reconnect and send
+        the image again.  Only if resume is set (for firmware supporting ACTION_RESUME) is the
+        device asked to carry on from the last acknowledged offset instead (see
+        AsyncOTAFW.send_update_file).
+
+        If cache (a FirmwareCache) is given then an application image (file_id 0) sent is
+        recorded in it so that its version can be learnt, and anything else sent cancels
+        learning from this device.
+        """
+        version = None
+        if cache:
+            version = await self.firmware_version()
+            cache.observe(self._address, version)
+        report = await self._send_firmware(data, file_id, timeout, write_without_response, window, progress, retries,
+                                           resume)
+        if report and cache:
+            if file_id == 0:
+                cache.updated(self._address, cache.fingerprint(data), version)
+            else:
+                cache.forget(self._address)
+        return report
+
+    async def _send_firmware(self, data, file_id, timeout, write_without_response, window, progress, retries, resume):
+        reconnect = False
+        self._cache.invalidate()
+        while True:
+            if reconnect:
+                await asyncio.sleep(OTA_RECONNECT_DELAY)
+                try:
+                    await self.reconnect()
+                except Exception as e:
+                    if retries <= 0:
+                        raise
+                    retries -= 1
+                    print('Reconnect failed:', e, '- retrying....')
+                    continue
+            try:
+                return await self._otafw.send_update_file(file_id, data, timeout, write_without_response, window,
+                                                          progress, resume and reconnect)
+            except OTAInterrupted as e:
+                if retries <= 0:
+                    raise
+                retries -= 1
+                print(e, '- reconnecting....')
+            reconnect = True
+
+    async def firmware_version(self):
+        return (await self._dte.parmr(['FW_APP_VERSION']))['FW_APP_VERSION']
+
+    async def firmware_update_if_needed(self, data, cache, file_id=0, **kwargs):
+        """Sends a firmware image unless the FirmwareCache knows it to be the version the
+        device is already running.  Returns the OTAReport, or None if the update was
+        skipped or refused.  Other arguments are as for firmware_update.
+        """
+        version = await self.firmware_version()
+        cache.observe(self._address, version)
+        if cache.is_current(cache.fingerprint(data), version):
+            print('Firmware {} is already current, skipping update'.format(version))
+            return None
+        return await self.firmware_update(data, file_id, cache=cache, **kwargs)
+
+    async def paspw(self, json_file_data):
+        await self._dte.paspw(json_file_data)
+        self._cache.invalidate(classes=[STATUS])
+
+    async def dumpd(self, log_type, sink=None, checkpoint=None):
+        return await self._dte.dumpd(log_type, sink, checkpoint)
+
+    async def dumpd_checkpoint(self, log_type, filename):
+        return DUMPDCheckpoint(filename, '{}:{}'.format(await self.identity(), log_type))
+
+    async def identity(self):
+        """Returns the DEVICE_DECID, else the ARGOS_DECID, else (neither being set) the
+        BLE address so that unconfigured trackers are not mistaken for each other.
+        """
+        ids = await self._dte.parmr(['DEVICE_DECID', 'ARGOS_DECID'])
+        return ids['DEVICE_DECID'] or ids['ARGOS_DECID'] or self._address
+
+    async def erase(self, log_type):
+        return await self._dte.erase(log_type)
+
+    async def factw(self):
+        await self._dte.factw()
+        self._cache.invalidate(classes=[CONFIG, STATUS])
+
+    async def rstvw(self, index):
+        await self._dte.rstvw(index)
+        self._cache.invalidate(classes=[STATUS])
+
+    async def rstbw(self):
+        await self._dte.rstbw()
+        self._cache.invalidate(classes=[STATUS])
+
+    async def deplw(self):
+        await self.rstbw()
+
+    async def scalw(self, sensor, step, value=0):
+        await self._dte.scalw(sensor, step, value)
+
+    async def scalr(self, sensor, step):
+        return await self._dte.scalr(sensor, step)
+
+    async def argostx(self, mod, power, freq, size, tcxo):
+        await self._dte.argostx(mod, power, freq, size, tcxo)
+
+    async def poll(self, key, repetitions=1):
+        for i in range(repetitions):
+            result = await self._dte.parmr([key])
+            print(result)
 
 
 class Tracker():
-    def __init__(self, address):
-        self._device = BLEDevice()
-        self._device.connect(address, 5)
-        self._dte = DTE(self._device)
-        self._otafw = OTAFW(self._device)
-        self._map = {}
+    """Synchronous interface to AsyncTracker over a BLEDevice"""
+
+    def __init__(self, address, device=None, write_without_response=False, status_ttl=STATUS_TTL, registry=None,
+                 pipeline_depth=NUS_PIPELINE_DEPTH):
+        self._device = device or BLEDevice()
+        self._tracker = AsyncTracker(address, self._device.async_device, write_without_response, status_ttl, registry,
+                                     pipeline_depth)
+        self._run(self._tracker.connect())
+
+    def _run(self, coro):
+        return self._device._await_bleak(coro)
 
     def sync(self):
-        a = self._dte.parmr()
-        b = self._dte.statr()
-        self._map = { **a, **b }
+        self._run(self._tracker.sync())
+
+    def set(self, param_values, diff=False):
+        return self._run(self._tracker.set(param_values, diff))
+
+    def changed(self, param_values):
+        return self._run(self._tracker.changed(param_values))
 
-    def set(self, param_values):
-        self._dte.parmw(param_values=param_values)
+    def verify(self, param_values):
+        return self._run(self._tracker.verify(param_values))
+
+    def disconnect(self):
+        self._run(self._tracker.disconnect())
+        # Releases the device from the runtime, the link itself is already closed
+        self._device.disconnect()
+
+    def refresh(self, params=None):
+        self._run(self._tracker.refresh(params))
 
     def get(self, attr=None):
-        return self._map[attr] if attr else self._map
+        return self._run(self._tracker.get(attr))
 
     def get_attrs(self):
-        return self._map.keys()
+        return self._tracker.get_attrs()
+
+    def firmware_update(self, data, file_id=0, timeout=None, write_without_response=False, window=OTA_WRITE_WINDOW,
+                        progress=None, retries=0, cache=None, resume=False):
+        return self._run(self._tracker.firmware_update(data, file_id, timeout, write_without_response, window, progress,
+                                                       retries, cache, resume))
+
+    def firmware_version(self):
+        return self._run(self._tracker.firmware_version())
 
-    def firmware_update(self, data, file_id=0, timeout=None):
-        self._otafw.send_update_file(file_id, data, timeout)
+    def firmware_update_if_needed(self, data, cache, file_id=0, **kwargs):
+        return self._run(self._tracker.firmware_update_if_needed(data, cache, file_id, **kwargs))
 
     def paspw(self, json_file_data):
-        self._dte.paspw(json_file_data)
+        self._run(self._tracker.paspw(json_file_data))
 
-    def dumpd(self, log_type):
-        return self._dte.dumpd(log_type)
+    def dumpd(self, log_type, sink=None, checkpoint=None):
+        return self._run(self._tracker.dumpd(log_type, sink, checkpoint))
+
+    def dumpd_checkpoint(self, log_type, filename):
+        return self._run(self._tracker.dumpd_checkpoint(log_type, filename))
+
+    def identity(self):
+        return self._run(self._tracker.identity())
 
     def erase(self, log_type):
-        return self._dte.erase(log_type)
+        return self._run(self._tracker.erase(log_type))
 
     def factw(self):
-        self._dte.factw()
+        self._run(self._tracker.factw())
 
     def rstvw(self, index):
-        self._dte.rstvw(index)
+        self._run(self._tracker.rstvw(index))
 
     def rstbw(self):
-        self._dte.rstbw()
+        self._run(self._tracker.rstbw())
 
     def deplw(self):
-        self._dte.rstbw()
+        self._run(self._tracker.deplw())
 
     def scalw(self, sensor, step, value=0):
-        self._dte.scalw(sensor, step, value)
+        self._run(self._tracker.scalw(sensor, step, value))
 
     def scalr(self, sensor, step):
-        return self._dte.scalr(sensor, step)
+        return self._run(self._tracker.scalr(sensor, step))
 
     def argostx(self, mod, power, freq, size, tcxo):
-        self._dte.argostx(mod, power, freq, size, tcxo)
+        self._run(self._tracker.argostx(mod, power, freq, size, tcxo))
 
     def poll(self, key, repetitions=1):
-        for i in range(repetitions):
-            result = self._dte.parmr([key])
-            print(result)
+        self._run(self._tracker.poll(key, repetitions))
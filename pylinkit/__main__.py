@@ -1,8 +1,11 @@
 import logging
 import argparse
+import json
 import sys
+import time
 import pylinkit
 from .utils import OrderedRawConfigParser, extract_firmware_file_from_dfu, create_wrapped_file_with_crc32
+from .log_transcode import FORMATS, LogStreamDecoder, format_from_filename, open_writer, transcode_file
 
 erase_options = ['sensor', 'system', 'all', 'als', 'ph', 'rtd', 'cdt', 'axl', 'pressure']
 dumpd_options = ['system', 'gnss', 'als', 'ph', 'rtd', 'cdt', 'axl', 'pressure']
@@ -16,20 +19,41 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--fw', type=argparse.FileType('rb'), required=False, help='Firmware filename for FW OTA update')
 parser.add_argument('--timeout', type=float, required=False, default=None, help='BLE communications timeout')
 parser.add_argument('--erase', type=str, choices=erase_options, required=False, help='Erase log file')
-parser.add_argument('--device', type=str, required=False, help='xx:xx:xx:xx:xx:xx BLE device address')
+parser.add_argument('--device', type=str, required=False, help='xx:xx:xx:xx:xx:xx BLE device address, or DECID, HEXID or name of a device in the registry')
+parser.add_argument('--devices', action='store_true', required=False, help='List the devices in the registry')
 parser.add_argument('--parmr', type=argparse.FileType('w'), required=False, help='Filename to write [PARAM] configuration to')
 parser.add_argument('--poll', type=str, required=False, help='Poll a parameter value by key and use --value to denote repetitions')
 parser.add_argument('--rstvw', type=str, choices=resetv_options.keys(), required=False, help='Reset variable: tx_counter or rx_counter')
 parser.add_argument('--rstbw', action='store_true', required=False, help='Reset beacon')
 parser.add_argument('--factw', action='store_true', required=False, help='Factory reset (WARNING: erases all stored logs and configuration!)')
 parser.add_argument('--parmw', type=argparse.FileType('r'), required=False, help='Filename to read [PARAM] configuration from')
+parser.add_argument('--diff', action='store_true', required=False, help='Write only the --parmw parameters that differ from the device and verify them')
 parser.add_argument('--paspw', type=argparse.FileType('r'), required=False, help='Filename (JSON) to read pass predict configuration from')
 parser.add_argument('--scan', action='store_true', required=False, help='Scan for beacons')
+parser.add_argument('--scan_timeout', type=float, default=None, required=False, help='Longest --scan time in seconds (default 2)')
+parser.add_argument('--scan_name', type=str, required=False, help='Regular expression that --scan device names must match')
+parser.add_argument('--scan_count', type=int, required=False, help='Stop --scan once this many devices are found')
+parser.add_argument('--write_without_response', action='store_true', required=False, help='Write DTE commands and OTA data without response for higher throughput')
+parser.add_argument('--pipeline_depth', type=int, default=1, required=False, help='Number of DTE commands written without waiting for earlier responses (default 1: stop-and-wait)')
+parser.add_argument('--ota_window', type=int, default=16, required=False, help='Writes per acknowledged write for --fw/--ano with --write_without_response')
+parser.add_argument('--fw_force', action='store_true', required=False, help='Send --fw even if the device is known to run it already')
+parser.add_argument('--fw_version', type=str, required=False, help='FW_APP_VERSION of the --fw image, recorded in the firmware cache')
+parser.add_argument('--ota_retries', type=int, default=3, required=False, help='Reconnects to retry --fw/--ano if the link drops')
+parser.add_argument('--ota_resume', action='store_true', required=False, help='Resume --fw/--ano after a reconnect, for firmware supporting it')
 parser.add_argument('--debug', action='store_true', required=False, help='Turn on debug trace')
-parser.add_argument('--dump_sensor', type=argparse.FileType('wb'), required=False, help='Dump sensor log file')
-parser.add_argument('--dump_system', type=argparse.FileType('wb'), required=False, help='Dump system log file')
-parser.add_argument('--dumpd', type=argparse.FileType('wb'), required=False, help='Dump the specified log file')
+parser.add_argument('--dump_sensor', type=str, required=False, help='Dump sensor log file')
+parser.add_argument('--dump_system', type=str, required=False, help='Dump system log file')
+parser.add_argument('--dumpd', type=str, required=False, help='Dump the specified log file')
 parser.add_argument('--dumpd_type', type=str, choices=dumpd_options, required=False, help='Specified log file')
+parser.add_argument('--harvest', type=str, choices=['sensor'] + dumpd_options, required=False, help='Dump a log file and show only records that are new since the last harvest')
+parser.add_argument('--cache_dir', type=str, default=None, required=False, help='Log harvest cache directory')
+parser.add_argument('--fleet', type=str, required=False, help='Provision or update many devices with --parmw/--paspw/--fw: comma separated addresses or a file of one address per line')
+parser.add_argument('--concurrency', type=int, default=None, required=False, help='Maximum number of devices handled concurrently with --fleet (default: 8, or 4 for --fw)')
+parser.add_argument('--fleet_retries', type=int, default=2, required=False, help='Times a failed device is requeued with --fleet --fw')
+parser.add_argument('--format', type=str, choices=FORMATS, required=False, help='Log file output format (default: from the output filename extension, otherwise bin)')
+parser.add_argument('--transcode', type=str, nargs=2, metavar=('LOG_FILE', 'OUTPUT'), required=False, help='Transcode an existing binary log file to --format')
+parser.add_argument('--export', type=str, nargs=2, metavar=('LOG_FILE', 'OUTPUT'), required=False, help='Export a binary log file to columnar .parquet or .npz')
+parser.add_argument('--resume', action='store_true', required=False, help='Resume an interrupted log file dump')
 parser.add_argument('--gui', action='store_true', required=False, help='Launch in GUI mode')
 parser.add_argument('--argostx', action='store_true', required=False, help='Send argos TX packet')
 parser.add_argument('--argosmod', type=str, default='A2', required=False, help='Argos modulation (A2, A3)')
@@ -58,6 +82,83 @@ def setup_logging(enabled, level):
             logging.getLogger().setLevel(logging.DEBUG)
 
 
+def dump_log(dev, log_type, filename):
+    fmt = args.format or format_from_filename(filename)
+    if fmt != 'bin':
+        if args.resume:
+            print('--resume requires --format bin, use --transcode once the dump is complete')
+            return
+        with open(filename, 'w', newline='') as f:
+            decoder = LogStreamDecoder(open_writer(f, fmt))
+            dev.dumpd(log_type, decoder)
+            decoder.close()
+        return
+    if not args.resume:
+        with open(filename, 'wb') as f:
+            dev.dumpd(log_type, f)
+        return
+    checkpoint = dev.dumpd_checkpoint(log_type, filename)
+    try:
+        dev.dumpd(log_type, checkpoint.file, checkpoint)
+        checkpoint.complete()
+    finally:
+        checkpoint.close()
+
+
+def resolve_device(registry, key):
+    address = registry.lookup(key)
+    if address is None:
+        print('Unknown device {}, use its address or --scan for it first'.format(key), file=sys.stderr)
+        sys.exit(1)
+    return address
+
+
+def list_devices(registry):
+    print('{:<20} {:<16} {:>5} {:<20} {:>10} {:>10}  {}'.format('ADDRESS', 'NAME', 'RSSI', 'LAST SEEN', 'DEVICE_DECID',
+                                                                'ARGOS_DECID', 'FW_APP_VERSION'))
+    for address, x in sorted(registry.devices().items()):
+        last_seen = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(x['last_seen'])) if x.get('last_seen') else ''
+        print('{:<20} {:<16} {:>5} {:<20} {:>10} {:>10}  {}'.format(address, str(x.get('name') or ''), str(x.get('rssi') or ''),
+                                                                    last_seen, str(x.get('DEVICE_DECID', '')),
+                                                                    str(x.get('ARGOS_DECID', '')), x.get('FW_APP_VERSION', '')))
+
+
+def fleet_main(registry):
+    import asyncio
+    from .fleet import read_addresses, provision_fleet, update_fleet, format_results, DEFAULT_CONCURRENCY, \
+        DEFAULT_OTA_CONCURRENCY
+    addresses = [resolve_device(registry, x) for x in read_addresses(args.fleet)]
+    tracker_factory = lambda address: pylinkit.AsyncTracker(address, registry=registry, pipeline_depth=args.pipeline_depth)
+    results = []
+    if args.parmw or args.paspw:
+        param_values = None
+        if args.parmw:
+            cfg = OrderedRawConfigParser()
+            cfg.optionxform = lambda option: option
+            cfg.read_string(args.parmw.read())
+            param_values = dict(cfg['PARAM'])
+        paspw = args.paspw.read() if args.paspw else None
+        results += asyncio.run(provision_fleet(addresses, param_values, paspw, args.concurrency or DEFAULT_CONCURRENCY,
+                                               tracker_factory=tracker_factory, on_result=lambda r: print(r.address, 'OK' if r.ok else 'FAIL'),
+                                               diff=args.diff))
+    if args.fw:
+        if (args.fw.name.endswith('.zip')):
+            data = extract_firmware_file_from_dfu(args.fw)
+        else:
+            data = args.fw.read()
+        cache = pylinkit.FirmwareCache()
+        if args.fw_version:
+            cache.register(cache.fingerprint(data), args.fw_version)
+        results += asyncio.run(update_fleet(addresses, data, 0, cache, args.concurrency or DEFAULT_OTA_CONCURRENCY,
+                                            args.fleet_retries, tracker_factory=tracker_factory, on_status=lambda address, status: print(address, status),
+                                            force=args.fw_force,
+                                            timeout=args.timeout, write_without_response=args.write_without_response,
+                                            window=args.ota_window, retries=args.ota_retries, resume=args.ota_resume))
+    print(format_results(results))
+    if not all(r.ok for r in results):
+        sys.exit(1)
+
+
 def gui_main():
     from .gui import run
     run()
@@ -76,9 +177,28 @@ def main():
     if args.gui:
         gui_main()
 
+    if args.transcode:
+        count = transcode_file(args.transcode[0], args.transcode[1], args.format)
+        print('Transcoded {} records to {}'.format(count, args.transcode[1]))
+
+    if args.export:
+        from .log_export import export
+        with open(args.export[0], 'rb') as f:
+            count = export(f.read(), args.export[1])
+        print('Exported {} records to {}'.format(count, args.export[1]))
+
+    registry = pylinkit.DeviceRegistry()
+    if args.devices:
+        list_devices(registry)
+
+    if args.fleet:
+        fleet_main(registry)
+        return
+
     dev = None
     if args.device:
-        dev = pylinkit.Tracker(args.device)
+        dev = pylinkit.Tracker(resolve_device(registry, args.device), write_without_response=args.write_without_response,
+                               registry=registry, pipeline_depth=args.pipeline_depth)
 
     if args.parmr:
         dev.sync()
@@ -97,34 +217,53 @@ def main():
         cfg = OrderedRawConfigParser()
         cfg.optionxform = lambda option: option
         cfg.read_string(args.parmw.read())
-        dev.set(cfg['PARAM'])
+        written = dev.set(dict(cfg['PARAM']), args.diff)
+        if args.diff:
+            print('Wrote {} changed parameters: {}'.format(len(written), ','.join(written)))
 
     if args.paspw:
         dev.paspw(args.paspw.read())
 
     if args.dump_sensor:
-        args.dump_sensor.write(dev.dumpd('sensor'))
-        args.dump_sensor.close()
+        dump_log(dev, 'sensor', args.dump_sensor)
 
     if args.dump_system:
-        args.dump_system.write(dev.dumpd('system'))
-        args.dump_system.close()
+        dump_log(dev, 'system', args.dump_system)
 
     if args.dumpd and args.dumpd_type:
-        args.dumpd.write(dev.dumpd(args.dumpd_type))
-        args.dumpd.close()
+        dump_log(dev, args.dumpd_type, args.dumpd)
+
+    if args.harvest:
+        cache = pylinkit.LogCache(args.cache_dir) if args.cache_dir else pylinkit.LogCache()
+        count = 0
+        for r in cache.harvest(dev, args.harvest):
+            print(json.dumps(r))
+            count += 1
+        print('{} new records since last harvest'.format(count), file=sys.stderr)
 
     if args.erase:
         dev.erase(args.erase)
 
     if args.fw:
         if (args.fw.name.endswith('.zip')):
-            dev.firmware_update(extract_firmware_file_from_dfu(args.fw), 0, args.timeout)
+            data = extract_firmware_file_from_dfu(args.fw)
+        else:
+            data = args.fw.read()
+        cache = pylinkit.FirmwareCache()
+        if args.fw_version:
+            cache.register(cache.fingerprint(data), args.fw_version)
+        if args.fw_force:
+            dev.firmware_update(data, 0, args.timeout, args.write_without_response, args.ota_window,
+                                retries=args.ota_retries, cache=cache, resume=args.ota_resume)
         else:
-            dev.firmware_update(args.fw.read(), 0, args.timeout)
+            dev.firmware_update_if_needed(data, cache, 0, timeout=args.timeout,
+                                          write_without_response=args.write_without_response,
+                                          window=args.ota_window, retries=args.ota_retries,
+                                          resume=args.ota_resume)
 
     if args.ano:
-        dev.firmware_update(create_wrapped_file_with_crc32(args.ano.read()), 2, args.timeout)
+        dev.firmware_update(create_wrapped_file_with_crc32(args.ano.read()), 2, args.timeout, args.write_without_response, args.ota_window,
+                            retries=args.ota_retries, cache=pylinkit.FirmwareCache(), resume=args.ota_resume)
 
     if args.factw:
         dev.factw()
@@ -201,10 +340,9 @@ def main():
         dev.argostx(args.argosmod, args.argospower, args.argosfreq, args.argossize, args.argostcxo)
 
     if args.scan:
-        scan_dev = pylinkit.Scanner()
-        result = scan_dev.scan()
-        for x in result:
-            print(x.address, x.name)
+        scan_dev = pylinkit.Scanner(registry)
+        scan_dev.scan(args.scan_timeout, name=args.scan_name, count=args.scan_count,
+                      on_device=lambda x: print(x.address, x.name))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+# End-to-end throughput benchmarks of the DTE, DTENUS and OTAFW stack
+# running against the simulated BLE backend.
+#
+# python -m pylinkit.benchmark [--mtu 23] [--latency 0.0] [--write_latency 0.0]
+
+import argparse
+import os
+import time
+from .dte import DTE
+from .ota_fw import OTAFW
+from .sim import SimulatedBLEDevice, SimulatedFirmware, make_gps_log
+from .utils import create_wrapped_file_with_crc32
+
+
+def _connect(firmware=None, **kwargs):
+    device = SimulatedBLEDevice(firmware=firmware, **kwargs)
+    device.connect(device.address, 5)
+    return device
+
+
+def bench_commands(count=100, write_without_response=False, **kwargs):
+    """Returns commands/sec for alternating PARMR/STATR/PARMW round trips"""
+    device = _connect(**kwargs)
+    dte = DTE(device, write_without_response)
+    start = time.perf_counter()
+    for i in range(count):
+        if i % 3 == 0:
+            dte.parmr()
+        elif i % 3 == 1:
+            dte.statr()
+        else:
+            dte.parmw({'PROFILE_NAME': 'BENCH', 'ARGOS_POWER': 500, 'GNSS_DELTATIME_ACQ': 60})
+    elapsed = time.perf_counter() - start
+    device.disconnect()
+    return count / elapsed
+
+
+def bench_dumpd(records=2000, **kwargs):
+    """Returns DUMPD bytes/sec for a sensor log of the given number of GPS records"""
+    data = make_gps_log(records)
+    device = _connect(firmware=SimulatedFirmware(logs={'sensor': data}), **kwargs)
+    dte = DTE(device)
+    start = time.perf_counter()
+    result = dte.dumpd('sensor')
+    elapsed = time.perf_counter() - start
+    device.disconnect()
+    if result != data:
+        raise Exception('DUMPD data mismatch')
+    return len(data) / elapsed
+
+
+def bench_ota(size=64 * 1024, write_without_response=False, **kwargs):
+    """Returns OTA bytes/sec for a random image of the given size"""
+    data = create_wrapped_file_with_crc32(os.urandom(size))
+    device = _connect(**kwargs)
+    # The post-transfer clean up delay is device time, not link throughput
+    otafw = OTAFW(device, cleanup_delay=0)
+    start = time.perf_counter()
+    otafw.send_update_file(0, data, 60, write_without_response)
+    elapsed = time.perf_counter() - start
+    device.disconnect()
+    if device.ota_image != data:
+        raise Exception('OTA image mismatch')
+    return len(data) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mtu', type=int, default=23, help='Simulated ATT MTU')
+    parser.add_argument('--latency', type=float, default=0.0, help='Per-notification latency in seconds')
+    parser.add_argument('--write_latency', type=float, default=0.0, help='Per-write acknowledgement latency in seconds')
+    parser.add_argument('--write_without_response', action='store_true', help='Write DTE commands and OTA data without response')
+    parser.add_argument('--commands', type=int, default=100, help='Number of DTE commands to send')
+    parser.add_argument('--records', type=int, default=2000, help='Number of GPS records to DUMPD')
+    parser.add_argument('--ota_size', type=int, default=64 * 1024, help='OTA image size in bytes')
+    args = parser.parse_args()
+
+    link = dict(mtu=args.mtu, latency=args.latency, write_latency=args.write_latency)
+    print('commands/sec: {:.1f}'.format(bench_commands(args.commands, args.write_without_response, **link)))
+    print('DUMPD bytes/sec: {:.1f}'.format(bench_dumpd(args.records, **link)))
+    print('OTA bytes/sec: {:.1f}'.format(bench_ota(args.ota_size, args.write_without_response, **link)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,85 @@
 # Heavily based on https://github.com/adafruit/Adafruit_Blinka_bleio
-# This provides a synchronous interface to the asynchronous "Bleak" BLE library
+# AsyncBLEDevice runs directly on the caller's event loop.  BLEDevice provides a
+# synchronous interface to it by running it on the event loop thread of a BLERuntime
+# shared by all devices.
 
 from bleak import BleakScanner, BleakClient
 import threading
 import asyncio
 import atexit
+import logging
 
-class BLEDevice(object):
-
-    _SCAN_INTERVAL = 2.0
-
-    def __init__(self):
-
-        self._connection_client = None
 
-        self._bleak_loop = None
-        self._bleak_thread = threading.Thread(target=self._run_bleak_loop)
-        # Discard thread quietly on exit.
-        self._bleak_thread.daemon = True
-        self._bleak_thread_ready = threading.Event()
-        self._bleak_thread.start()
-        # Wait for thread to start.
-        self._bleak_thread_ready.wait()
-        self._scanner = None
+logger = logging.getLogger(__name__)
 
-        # Clean up connections, etc. when exiting (even by KeyboardInterrupt)
-        atexit.register(self._cleanup)
 
-    def _cleanup(self):
-        """Clean up connections, so that the underlying OS software does not
-        leave them open.
-        """
-        self.disconnect()
+class BluetoothError(Exception):
+    pass
 
-    def scan(self):
-        return self._await_bleak(self._scan_for_interval(self._SCAN_INTERVAL))
 
-    def connect(self, address, timeout: float):
-        return self._await_bleak(self._connect_async(address, timeout=timeout))
+DEFAULT_MTU = 23
 
-    def disconnect(self):
-        self._await_bleak(self._disconnect_async())
 
-    def char_write(self, uuid, value):
-        self._await_bleak(self._connection_client.write_gatt_char(uuid, bytearray(value)))
+class AsyncBLEDevice(object):
 
-    def char_read(self, uuid):
-        return self._await_bleak(self._connection_client.read_gatt_char(uuid))
+    _SCAN_INTERVAL = 2.0
 
-    def subscribe(self, uuid, callback):
-        self._await_bleak(self._connection_client.start_notify(uuid, lambda x, data: callback(x, bytes(data))))
+    def __init__(self):
+        self._connection_client = None
+        self._rssi = {}
 
+    @property
+    def mtu_size(self):
+        """The negotiated ATT MTU of the connection, or the BLE default if unknown"""
+        if self._connection_client is None:
+            return DEFAULT_MTU
+        return getattr(self._connection_client, 'mtu_size', None) or DEFAULT_MTU
 
-    async def _scan_for_interval(self, interval: float):
+    async def scan(self, interval: float = None):
         """Scan advertisements for the given interval and return ScanEntry objects
         for all advertisements heard.
         """
-        if not self._scanner:
-            self._scanner = BleakScanner(loop=self._bleak_loop)
-
-        await self._scanner.start()
-        await asyncio.sleep(interval)
-        await self._scanner.stop()
-        return self._scanner.discovered_devices if self._scanner.discovered_devices else []
-
-    async def _connect_async(self, address, timeout: float):
+        scanner = BleakScanner()
+        await scanner.start()
+        await asyncio.sleep(self._SCAN_INTERVAL if interval is None else interval)
+        await scanner.stop()
+        return scanner.discovered_devices if scanner.discovered_devices else []
+
+    async def scan_stream(self, interval: float = None, accept=None):
+        """Yields each device heard advertising, as soon as an advertisement from it is
+        accepted by accept(device) (default: the first), for at most interval seconds.
+        Scanning stops as soon as the caller stops iterating.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        yielded = set()
+
+        def detected(device, advertisement_data):
+            self._rssi[device.address] = advertisement_data.rssi
+            if device.address not in yielded and (accept is None or accept(device)):
+                yielded.add(device.address)
+                queue.put_nowait(device)
+
+        scanner = BleakScanner(detection_callback=detected)
+        await scanner.start()
+        try:
+            deadline = loop.time() + (self._SCAN_INTERVAL if interval is None else interval)
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    return
+        finally:
+            await scanner.stop()
+
+    def rssi(self, address):
+        """Returns the RSSI of the last advertisement heard from address by scan_stream"""
+        return self._rssi.get(address)
+
+    async def connect(self, address, timeout: float):
+        """Connects to an address, or to a device handle found by scanning which avoids
+        another discovery scan.
+        """
         if self._connection_client is not None:
             raise BluetoothError("Device already connected")
 
@@ -81,19 +96,143 @@ class BLEDevice(object):
         self._connection_client = client
         return client
 
-    async def _disconnect_async(self):
+    async def disconnect(self):
         """Disconnects from the remote peripheral. Does nothing if already disconnected."""
         if self._connection_client is not None:
-            await self._connection_client.disconnect()
+            client = self._connection_client
+            self._connection_client = None
+            await client.disconnect()
 
-    def _run_bleak_loop(self):
-        self._bleak_loop = asyncio.new_event_loop()
-        # Event loop is now available.
-        self._bleak_thread_ready.set()
-        self._bleak_loop.run_forever()
+    async def char_write(self, uuid, value, response=True):
+        await self._connection_client.write_gatt_char(uuid, bytearray(value), response=response)
 
-    def _await_bleak(self, coro, timeout=None):
-        """Call an async routine in the bleak thread from sync code, and await its result."""
+    async def char_read(self, uuid):
+        return await self._connection_client.read_gatt_char(uuid)
+
+    async def subscribe(self, uuid, callback):
+        await self._connection_client.start_notify(uuid, lambda x, data: callback(x, bytes(data)))
+
+
+class BLERuntime(object):
+    """A single event loop thread shared by all BLEDevice instances in the process.
+
+    BLERuntime.default() starts the shared runtime on first use.  Devices stay registered
+    until they are disconnected.  stop() disconnects all registered devices, cancels any
+    tasks left on the loop and stops it, and is also run at exit.
+    """
+
+    _default = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._devices = set()
+
+    @classmethod
+    def default(cls):
+        with cls._lock:
+            if cls._default is None or not cls._default.is_running():
+                cls._default = cls()
+                cls._default.start()
+            return cls._default
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            # Event loop is now available.
+            ready.set()
+            self._loop.run_forever()
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='BLERuntime')
+        # Discard thread quietly on exit.
+        self._thread.daemon = True
+        self._thread.start()
+        # Wait for thread to start.
+        ready.wait()
+        # Clean up connections, etc. when exiting (even by KeyboardInterrupt)
+        atexit.register(self.stop)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def register(self, device):
+        self._devices.add(device)
+
+    def unregister(self, device):
+        self._devices.discard(device)
+
+    def run(self, coro, timeout=None):
+        """Call an async routine in the runtime thread from sync code, and await its result."""
         # This is a concurrent.Future.
-        future = asyncio.run_coroutine_threadsafe(coro, self._bleak_loop)
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
         return future.result(timeout)
+
+    def stop(self, timeout=5.0):
+        """Disconnects all registered devices, so that the underlying OS software does not
+        leave them open, then stops the event loop thread.
+        """
+        if not self.is_running():
+            return
+        atexit.unregister(self.stop)
+        for device in list(self._devices):
+            try:
+                self.run(device.async_device.disconnect(), timeout)
+            except Exception as e:
+                logger.warning('Failed to disconnect device: %s', e)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+
+class BLEDevice(object):
+
+    _SCAN_INTERVAL = 2.0
+
+    def __init__(self, async_device=None, runtime=None):
+        self.async_device = async_device or AsyncBLEDevice()
+        self._runtime = runtime or BLERuntime.default()
+        self._runtime.register(self)
+
+    @property
+    def _bleak_loop(self):
+        return self._runtime.loop
+
+    def scan(self):
+        return self._await_bleak(self.async_device.scan(self._SCAN_INTERVAL))
+
+    def connect(self, address, timeout: float):
+        return self._await_bleak(self.async_device.connect(address, timeout=timeout))
+
+    def disconnect(self):
+        self._await_bleak(self.async_device.disconnect())
+        self._runtime.unregister(self)
+
+    @property
+    def mtu_size(self):
+        return self.async_device.mtu_size
+
+    def char_write(self, uuid, value, response=True):
+        self._await_bleak(self.async_device.char_write(uuid, value, response))
+
+    def char_read(self, uuid):
+        return self._await_bleak(self.async_device.char_read(uuid))
+
+    def subscribe(self, uuid, callback):
+        self._await_bleak(self.async_device.subscribe(uuid, callback))
+
+    def _await_bleak(self, coro, timeout=None):
+        """Call an async routine in the shared runtime thread from sync code, and await its result."""
+        return self._runtime.run(coro, timeout)
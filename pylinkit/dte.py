@@ -1,42 +1,65 @@
-from .dte_nus import DTENUS
+from .dte_nus import AsyncDTENUS, NUS_PIPELINE_DEPTH
 from .dte_params import DTEParamMap
 from .dte_types import BASE64, PASPW
-import re
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
-class DTE():
+# The payload length of a command is framed as 3 hex digits
+MAX_PAYLOAD_LENGTH = 0xFFF
 
-    def __init__(self, device):
-        self._nus = DTENUS(device)
 
-    def _encode_command(self, command, params=[], param_values={}, args=[]):
+class AsyncDTE():
+
+    def __init__(self, device, write_without_response=False, depth=NUS_PIPELINE_DEPTH):
+        self._nus = AsyncDTENUS(device, write_without_response, depth=depth)
+
+    def _encode_items(self, params=[], param_values={}, args=[]):
         if params:
-            payload = ','.join([DTEParamMap.param_to_key(x) for x in params])
-        elif args:
-            payload = ','.join(args)
-        elif param_values:
-            payload = ','.join(['{}={}'.format(DTEParamMap.param_to_key(x), DTEParamMap.encode(x, param_values[x])) for x in param_values])
-        else:
-            payload = ''
+            return [DTEParamMap.param_to_key(x) for x in params]
+        if args:
+            return args
+        return ['{}={}'.format(DTEParamMap.param_to_key(x), DTEParamMap.encode(x, param_values[x])) for x in param_values]
+
+    def _frame_command(self, command, payload):
+        if len(payload) > MAX_PAYLOAD_LENGTH:
+            raise Exception('{} payload of {} chars is too long'.format(command, len(payload)))
         return '${cmd}#{length:03x};{payload}\r'.format(cmd=command, length=len(payload), payload=payload)
 
-    def _decode_response(self, resp):
-        success_regexp = '^\\$O;(?P<cmd>[A-Z]+)#(?P<len>[0-9a-fA-F]+);(?P<payload>.*)\r$'
-        fail_regexp = '^\\$N;(?P<cmd>[A-Z]+)#(?P<len>[0-9a-fA-F]+);(?P<error>[0-9]+)\r$'
-        success = re.match(success_regexp, resp)
-        if success:
-            return success.group('payload')
-        fail = re.match(fail_regexp, resp)
-        if fail:
-            raise Exception('{} - error {}'.format(fail.group('cmd'), fail.group('error')))
-        raise Exception('Bad response - {}'.format(resp))
-
-    def _decode_multi_response(self, resp):
-        return [self._decode_response(r + '\r') for r in resp.split('\r') if r]
+    def _encode_command(self, command, params=[], param_values={}, args=[]):
+        return self._frame_command(command, ','.join(self._encode_items(params, param_values, args)))
+
+    def _encode_commands(self, command, params=[], param_values={}):
+        """Encodes a command as one or more commands, splitting the params so that no
+        payload exceeds MAX_PAYLOAD_LENGTH
+        """
+        commands = []
+        batch = []
+        length = 0
+        for x in self._encode_items(params, param_values):
+            if batch and length + 1 + len(x) > MAX_PAYLOAD_LENGTH:
+                commands.append(self._frame_command(command, ','.join(batch)))
+                batch = []
+            length = length + 1 + len(x) if batch else len(x)
+            batch.append(x)
+        if batch or not commands:
+            commands.append(self._frame_command(command, ','.join(batch)))
+        return commands
+
+    def _decode_frame(self, frame):
+        if frame.error is not None:
+            raise Exception('{} - error {}'.format(frame.cmd, frame.error))
+        return frame.payload
+
+    def _decode_response(self, frames):
+        if len(frames) != 1:
+            raise Exception('Bad response - {}'.format(frames))
+        return self._decode_frame(frames[0])
+
+    def _decode_multi_response(self, frames):
+        return [self._decode_frame(f) for f in frames]
 
     def _decode_key_values(self, payload):
         m = {}
@@ -45,19 +68,28 @@ class DTE():
             m[DTEParamMap.key_to_param(key)] = DTEParamMap.decode(key, value)
         return m
 
-    def parmr(self, params=[]):
-        resp = self._nus.send(self._encode_command('PARMR', params=params))
-        return self._decode_key_values(self._decode_response(resp))
+    async def _read(self, command, params):
+        m = {}
+        for resp in await self._nus.send_many(self._encode_commands(command, params=params)):
+            m.update(self._decode_key_values(self._decode_response(resp)))
+        return m
 
-    def statr(self, params=[]):
-        resp = self._nus.send(self._encode_command('STATR', params=params))
-        return self._decode_key_values(self._decode_response(resp))
+    async def parmr(self, params=[]):
+        return await self._read('PARMR', params)
 
-    def parmw(self, param_values={}):
-        resp = self._nus.send(self._encode_command('PARMW', param_values=param_values))
-        self._decode_response(resp)
+    async def statr(self, params=[]):
+        return await self._read('STATR', params)
 
-    def dumpd(self, log_type='sensor'):
+    async def parmw(self, param_values={}):
+        for resp in await self._nus.send_many(self._encode_commands('PARMW', param_values=param_values)):
+            self._decode_response(resp)
+
+    async def dumpd(self, log_type='sensor', sink=None, checkpoint=None):
+        """Dumps a log file.  If sink is given (a file-like object or callable) then each
+        chunk is decoded and written to it as it arrives and the total byte count is
+        returned, otherwise the log file data is returned.  Chunks already recorded by
+        checkpoint (see DUMPDCheckpoint) are skipped.
+        """
         log_d = {'system': 0,
                  'sensor': 1,
                  'gnss': 1,
@@ -67,20 +99,32 @@ class DTE():
                  'cdt': 5,
                  'axl': 6,
                  'pressure': 7 }
-        resp = self._nus.send(self._encode_command('DUMPD', args=['{}'.format(log_d[log_type])]), multi_response=True)
-        responses = self._decode_multi_response(resp)
-        raw_data = b''
-        for r in responses:
-            _, _, data = r.split(',')
-            decoded_data = BASE64.decode(data)
-            raw_data += decoded_data
-        return raw_data
-
-    def paspw(self, json_file_data):
-        resp = self._nus.send(self._encode_command('PASPW', args=[PASPW.encode(json_file_data)]), timeout=5.0)
+        chunks = []
+        if sink is None:
+            write = chunks.append
+        else:
+            write = sink.write if hasattr(sink, 'write') else sink
+        total = 0
+
+        def on_frame(frame):
+            nonlocal total
+            data = self._decode_frame(frame)
+            if checkpoint is not None and not checkpoint.accept(frame.mmm, frame.MMM):
+                return
+            data = BASE64.decode(data)
+            write(data)
+            total += len(data)
+            if checkpoint is not None:
+                checkpoint.advance(frame.mmm, len(data))
+
+        await self._nus.send(self._encode_command('DUMPD', args=['{}'.format(log_d[log_type])]), on_frame=on_frame)
+        return total if sink is not None else b''.join(chunks)
+
+    async def paspw(self, json_file_data):
+        resp = await self._nus.send(self._encode_command('PASPW', args=[PASPW.encode(json_file_data)]), timeout=5.0)
         self._decode_response(resp)
 
-    def erase(self, log_type):
+    async def erase(self, log_type):
         log_d = {'all': 3,
                  'system': 2,
                  'sensor': 1,
@@ -91,22 +135,22 @@ class DTE():
                  'cdt': 7,
                  'axl': 8,
                  'pressure': 9 }
-        resp = self._nus.send(self._encode_command('ERASE', args=['{}'.format(log_d[log_type])]))
+        resp = await self._nus.send(self._encode_command('ERASE', args=['{}'.format(log_d[log_type])]))
         self._decode_response(resp)
 
-    def factw(self):
-        resp = self._nus.send(self._encode_command('FACTW'))
+    async def factw(self):
+        resp = await self._nus.send(self._encode_command('FACTW'))
         self._decode_response(resp)
 
-    def rstvw(self, var_id):
-        resp = self._nus.send(self._encode_command('RSTVW', args=[str(var_id)]))
+    async def rstvw(self, var_id):
+        resp = await self._nus.send(self._encode_command('RSTVW', args=[str(var_id)]))
         self._decode_response(resp)
 
-    def rstbw(self):
-        resp = self._nus.send(self._encode_command('RSTBW'))
+    async def rstbw(self):
+        resp = await self._nus.send(self._encode_command('RSTBW'))
         self._decode_response(resp)
 
-    def scalw(self, sensor, step, value):
+    async def scalw(self, sensor, step, value):
         sensor_d = {'axl': 0,
                     'pressure': 1,
                     'als': 2,
@@ -114,10 +158,10 @@ class DTE():
                     'rtd': 4,
                     'cdt': 5,
                     'mcp47x6': 6 }
-        resp = self._nus.send(self._encode_command('SCALW', args=[str(sensor_d[sensor]), str(step), str(value)]))
+        resp = await self._nus.send(self._encode_command('SCALW', args=[str(sensor_d[sensor]), str(step), str(value)]))
         self._decode_response(resp)
 
-    def scalr(self, sensor, step):
+    async def scalr(self, sensor, step):
         sensor_d = {'axl': 0,
                     'pressure': 1,
                     'als': 2,
@@ -125,12 +169,59 @@ class DTE():
                     'rtd': 4,
                     'cdt': 5,
                     'mcp47x6': 6 }
-        resp = self._nus.send(self._encode_command('SCALR', args=[str(sensor_d[sensor]), str(step)]))
+        resp = await self._nus.send(self._encode_command('SCALR', args=[str(sensor_d[sensor]), str(step)]))
         return self._decode_response(resp)
 
-    def argostx(self, mod, power, freq, size, tcxo):
+    async def argostx(self, mod, power, freq, size, tcxo):
         mod_d = {'A2': 0,
                  'A3': 1,
                  'A4': 2}
-        resp = self._nus.send(self._encode_command('SATTX', args=[str(mod_d[mod]), str(power), str(freq), str(size), str(tcxo)]))
+        resp = await self._nus.send(self._encode_command('SATTX', args=[str(mod_d[mod]), str(power), str(freq), str(size), str(tcxo)]))
         self._decode_response(resp)
+
+
+class DTE():
+    """Synchronous interface to AsyncDTE over a BLEDevice"""
+
+    def __init__(self, device, write_without_response=False, depth=NUS_PIPELINE_DEPTH):
+        self._device = device
+        self._dte = AsyncDTE(device.async_device, write_without_response, depth)
+
+    def _run(self, coro):
+        return self._device._await_bleak(coro)
+
+    def parmr(self, params=[]):
+        return self._run(self._dte.parmr(params))
+
+    def statr(self, params=[]):
+        return self._run(self._dte.statr(params))
+
+    def parmw(self, param_values={}):
+        self._run(self._dte.parmw(param_values))
+
+    def dumpd(self, log_type='sensor', sink=None, checkpoint=None):
+        return self._run(self._dte.dumpd(log_type, sink, checkpoint))
+
+    def paspw(self, json_file_data):
+        self._run(self._dte.paspw(json_file_data))
+
+    def erase(self, log_type):
+        self._run(self._dte.erase(log_type))
+
+    def factw(self):
+        self._run(self._dte.factw())
+
+    def rstvw(self, var_id):
+        self._run(self._dte.rstvw(var_id))
+
+    def rstbw(self):
+        self._run(self._dte.rstbw())
+
+    def scalw(self, sensor, step, value):
+        self._run(self._dte.scalw(sensor, step, value))
+
+    def scalr(self, sensor, step):
+        return self._run(self._dte.scalr(sensor, step))
+
+    def argostx(self, mod, power, freq, size, tcxo):
+        self._run(self._dte.argostx(mod, power, freq, size, tcxo))
@@ -1,39 +1,68 @@
+import asyncio
+import collections
 import logging
 import re
-from threading import Event
+import time
+from collections import namedtuple
 
 
 logger = logging.getLogger(__name__)
 
 
 NUS_CHAR_LENGTH = 20
+NUS_WRITE_WINDOW = 8
+NUS_PIPELINE_DEPTH = 1
 NUS_RX_CHAR_UUID = '6E400002-B5A3-F393-E0A9-E50E24DCCA9E'
 NUS_TX_CHAR_UUID = '6E400003-B5A3-F393-E0A9-E50E24DCCA9E'
 
 
+# For DUMPD frames payload is the chunk data alone and mmm and MMM are the indices of the
+# chunk and of the last chunk, otherwise they are None
+DTEFrame = namedtuple('DTEFrame', ['cmd', 'length', 'payload', 'error', 'mmm', 'MMM'])
+
+RESPONSE_HEADER_REGEXP = re.compile('\\$(?P<status>[ON]);(?P<cmd>[A-Z]+)#(?P<len>[0-9a-fA-F]+);')
+RESPONSE_ERROR_REGEXP = re.compile('(?P<error>[0-9]+)\r')
+COMMAND_REGEXP = re.compile('\\$(?P<cmd>[A-Z]+)#')
+
+
 class DTENUSProtocol():
-    def __init__(self):
+    """Parses the notification stream into DTEFrame objects, each frame exactly once.
+
+    Completed frames are passed to on_frame if given, otherwise they are retained.
+    push() returns any data received after the response terminated, which belongs to
+    the next response.  If the caller has already matched RESPONSE_HEADER_REGEXP at the
+    start of buffer then it passes the match as header so that it is not matched again.
+    """
+
+    def __init__(self, on_frame=None):
         self.reset()
-        self._queued_data = ''
+        self._frames = []
+        self._on_frame = on_frame or self._frames.append
 
-    def data(self):
-        return self._queued_data
+    def frames(self):
+        return self._frames
 
-    def push(self, buffer):
-        self._queued_data += buffer
+    def push(self, buffer, header=None):
         if self._expected_length == 0:
-            buffer = self._extract_header(buffer)
+            buffer = self._extract_header(buffer, header)
+            if self._is_terminated:
+                return buffer
+        rest = ''
         if buffer:
             if self._is_header(buffer):
                 self.reset()
                 logger.error(f'Unexpected header received: {buffer}')
                 raise Exception()
             if self._expected_length < len(buffer):
-                self.reset()
-                logger.error(f'Too many bytes received: remaining {self._expected_length} got {len(buffer)}')
-                raise Exception()
+                if not self._is_header(buffer[self._expected_length:]):
+                    self.reset()
+                    logger.error(f'Too many bytes received: remaining {self._expected_length} got {len(buffer)}')
+                    raise Exception()
+                buffer, rest = buffer[:self._expected_length], buffer[self._expected_length:]
             self._expected_length -= len(buffer)
+            self._payload.append(buffer)
             if self._expected_length == 0:
+                self._complete_frame()
                 if self._expected_MMM is not None:
                     percent = int((100 * (self._last_mmm+1)) / (self._expected_MMM+1))
                     print(f'{percent:.2f}%', end='\r')
@@ -41,6 +70,9 @@ class DTENUSProtocol():
                         self.reset()
                 else:
                     self.reset()
+        if rest and not self._is_terminated:
+            return self.push(rest)
+        return rest
 
     def is_terminated(self):
         return self._is_terminated
@@ -50,88 +82,222 @@ class DTENUSProtocol():
         self._expected_MMM = None
         self._is_terminated = True
         self._last_mmm = None
+        self._cmd = None
+        self._length = 0
+        self._data_start = 0
+        self._payload = []
 
     def _is_header(self, buffer):
         return buffer[0] == '$'
 
-    def _extract_header(self, buffer):
-        success_regexp = '^\\$O;(?P<cmd>[A-Z]+)#(?P<len>[0-9a-fA-F]+);(?P<payload>.*)'
-        fail_regexp = '^\\$N;(?P<cmd>[A-Z]+)#(?P<len>[0-9a-fA-F]+);(?P<error>[0-9]+)\r$'
-        success = re.match(success_regexp, buffer)
-        if success:
-            self._is_terminated = False
-            self._expected_length = int(success.group('len'), 16) + 1  # +1 for \r terminator
-            buffer = success.group('payload')
-            if success.group('cmd') == 'DUMPD':
-                try:
-                    args = buffer.split(',')
-                    mmm = int(args[0],16)
-                    MMM = int(args[1],16)
-                    if self._last_mmm is None:
-                        if mmm != 0:
-                            self.reset()
-                            logger.error(f'First DUMPD mmm must be zero: got {mmm}')
-                            raise Exception()
-                        if MMM < 0:
-                            self.reset()
-                            logger.error(f'First DUMPD MMM must be >=0: got {MMM}')
-                            raise Exception()
-                        self._last_mmm = 0
-                        self._expected_MMM = MMM
-                    else:
-                        self._last_mmm += 1
-                        if mmm != self._last_mmm:
-                            self.reset()
-                            logger.error(f'Unexpected DUMPD mmm: got {mmm} but expected {self._last_mmm}')
-                            raise Exception()
-                        if mmm > self._expected_MMM:
-                            self.reset()
-                            logger.error(f'Unexpected DUMPD mmm: got {mmm} which exceeds {self._expected_MMM}')
-                            raise Exception()
-                except:
-                    self.reset()
-                    logger.error(f'Unexpected DUMPD payload: {buffer}')
-                    raise Exception()
-            return buffer
+    def _complete_frame(self):
+        payload = ''.join(self._payload)
+        self._payload = []
+        if payload[-1] != '\r':
+            self.reset()
+            logger.error(f'Missing frame terminator: {payload}')
+            raise Exception()
+        if self._expected_MMM is None:
+            self._on_frame(DTEFrame(self._cmd, self._length, payload[:-1], None, None, None))
+        else:
+            self._on_frame(DTEFrame(self._cmd, self._length, payload[self._data_start:-1], None, self._last_mmm,
+                                    self._expected_MMM))
 
-        fail = re.match(fail_regexp, buffer)
-        if fail:
+    def _extract_header(self, buffer, header=None):
+        header = header or RESPONSE_HEADER_REGEXP.match(buffer)
+        if header is None:
             self.reset()
-            return ''
+            raise Exception(f'Malformed header received: {buffer}')
 
-        self.reset()
-        raise Exception(f'Malformed header received: {buffer}')
+        cmd = header.group('cmd')
+        length = int(header.group('len'), 16)
+        buffer = buffer[header.end():]
 
-class DTENUS():
-    def __init__(self, device):
+        if header.group('status') == 'N':
+            fail = RESPONSE_ERROR_REGEXP.match(buffer)
+            self.reset()
+            if fail is None:
+                raise Exception(f'Malformed error received: {buffer}')
+            self._on_frame(DTEFrame(cmd, length, None, fail.group('error'), None, None))
+            return buffer[fail.end():]
+
+        self._is_terminated = False
+        self._expected_length = length + 1  # +1 for \r terminator
+        self._cmd = cmd
+        self._length = length
+        if cmd == 'DUMPD':
+            try:
+                args = buffer.split(',', 2)
+                mmm = int(args[0],16)
+                MMM = int(args[1],16)
+                self._data_start = len(args[0]) + len(args[1]) + 2
+                if self._last_mmm is None:
+                    if mmm != 0:
+                        self.reset()
+                        logger.error(f'First DUMPD mmm must be zero: got {mmm}')
+                        raise Exception()
+                    if MMM < 0:
+                        self.reset()
+                        logger.error(f'First DUMPD MMM must be >=0: got {MMM}')
+                        raise Exception()
+                    self._last_mmm = 0
+                    self._expected_MMM = MMM
+                else:
+                    self._last_mmm += 1
+                    if mmm != self._last_mmm:
+                        self.reset()
+                        logger.error(f'Unexpected DUMPD mmm: got {mmm} but expected {self._last_mmm}')
+                        raise Exception()
+                    if mmm > self._expected_MMM:
+                        self.reset()
+                        logger.error(f'Unexpected DUMPD mmm: got {mmm} which exceeds {self._expected_MMM}')
+                        raise Exception()
+            except:
+                self.reset()
+                logger.error(f'Unexpected DUMPD payload: {buffer}')
+                raise Exception()
+        return buffer
+
+class DTERequest():
+    """A command awaiting its response"""
+
+    def __init__(self, cmd, on_frame=None):
+        self.cmd = cmd
+        self.protocol = DTENUSProtocol(on_frame)
+        self.event = asyncio.Event()
+        self.started = False
+        self.done = False
+        self.error = None
+        # Time after which an abandoned request no longer expects a response
+        self.abandoned = None
+
+
+class AsyncDTENUS():
+    """Commands are written in chunks of MTU-3 bytes.  If write_without_response is set
+    then chunks are written without response, except every window'th and the last chunk
+    which are acknowledged, bounding the number of unacknowledged writes in flight.
+
+    If depth is greater than 1 then concurrent send() calls are pipelined: up to depth
+    commands are written without waiting for earlier responses, and responses are
+    matched to commands in the order they were written.  The default depth of 1 is
+    strictly stop-and-wait.
+
+    A request that times out stays queued as abandoned so that a late response to it is
+    drained and discarded rather than passed to the next request.  At depth 1 an abandoned
+    request whose response has not started by the time the next command is written is
+    taken to have lost its response and is dropped.
+    """
+
+    def __init__(self, device, write_without_response=False, window=NUS_WRITE_WINDOW, depth=NUS_PIPELINE_DEPTH):
         self._device = device
-        self._event = Event()
-        self._queued_data = ''
-        device.subscribe(NUS_TX_CHAR_UUID, self._data_handler)
-    
-    def send(self, data, timeout=6.0, multi_response=False):
-        self._protocol = DTENUSProtocol()
-        self._queued_data = ''
-        self._terminate = False
-        self._event.clear()
-        for x in [ data[0+i:NUS_CHAR_LENGTH+i] for i in range(0, len(data), NUS_CHAR_LENGTH) ]:
-            logger.debug('PC -> DTE: %s', x.encode('ascii'))
-            self._device.char_write(NUS_RX_CHAR_UUID, x.encode('ascii'))
-        while True:
-            is_set = self._event.wait(timeout)
-            if not is_set:
-                raise Exception('Timeout')
-            else:
-                if self._terminate:
-                    break
-        return self._protocol.data()
+        self._write_without_response = write_without_response
+        self._window = window
+        self._depth = depth
+        self._pending = collections.deque()
+        self._slots = None
+        self._write_lock = None
+        self._subscribed = False
+
+    async def send(self, data, timeout=6.0, on_frame=None):
+        """Writes a command and returns its response frames.  timeout is the longest
+        time allowed without receiving any response data.  The protocol itself knows
+        when a response of several frames (DUMPD) is complete.  If on_frame is given
+        then frames are passed to it as they complete instead of being returned.
+        """
+        if self._slots is None:
+            # Created here so that they belong to the running event loop
+            self._slots = asyncio.Semaphore(self._depth)
+            self._write_lock = asyncio.Lock()
+        command = COMMAND_REGEXP.match(data)
+        request = DTERequest(command.group('cmd') if command else None, on_frame)
+        async with self._slots:
+            try:
+                async with self._write_lock:
+                    if not self._subscribed:
+                        await self._device.subscribe(NUS_TX_CHAR_UUID, self._data_handler)
+                        self._subscribed = True
+                    if self._depth == 1:
+                        # Stop-and-wait: the response to an abandoned command that has not
+                        # started by now is lost, and must not be taken for this response
+                        self._pending = collections.deque(x for x in self._pending if x.started)
+                    self._pending.append(request)
+                    await self._write(data.encode('ascii'))
+                while not request.done:
+                    try:
+                        await asyncio.wait_for(request.event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        raise Exception('Timeout') from None
+                    request.event.clear()
+            finally:
+                if not request.done and request in self._pending:
+                    request.abandoned = time.monotonic() + timeout
+        if request.error:
+            raise Exception('Bad response') from request.error
+        return request.protocol.frames()
+
+    async def send_many(self, commands, timeout=6.0):
+        """Pipelines commands and returns their response frames in order"""
+        responses = await asyncio.gather(*[self.send(x, timeout) for x in commands], return_exceptions=True)
+        for x in responses:
+            if isinstance(x, Exception):
+                raise x
+        return responses
+
+    async def _write(self, data):
+        size = max(NUS_CHAR_LENGTH, self._device.mtu_size - 3)
+        chunks = range(0, len(data), size)
+        for n, i in enumerate(chunks, 1):
+            x = data[i:i+size]
+            logger.debug('PC -> DTE: %s', x)
+            response = not self._write_without_response or n % self._window == 0 or n == len(chunks)
+            await self._device.char_write(NUS_RX_CHAR_UUID, x, response)
 
     def _data_handler(self, _, data):
         logger.debug('PC <- DTE: %s', data.decode('ascii'))
-        try:
-            self._protocol.push(data.decode('ascii'))
-            self._terminate = self._protocol.is_terminated()
-        except:
-            self._terminate = True
-        self._event.set()
-        self._event.clear()
+        buffer = data.decode('ascii')
+        # Any response data shows the link is alive, so restart every waiter's timeout
+        for request in self._pending:
+            request.event.set()
+        now = time.monotonic()
+        while buffer and self._pending:
+            request = self._pending[0]
+            resumed = request.started
+            if not request.started:
+                header = RESPONSE_HEADER_REGEXP.match(buffer)
+                matched = header is not None and (request.cmd is None or header.group('cmd') == request.cmd)
+                if request.abandoned is not None and (request.abandoned < now or (header and not matched)):
+                    # The response to an abandoned request never arrived
+                    self._pending.popleft()
+                    continue
+                if not matched:
+                    # Discard the remainder of a response that has already failed
+                    logger.debug('Discarding unexpected response data: %s', buffer)
+                    return
+                request.started = True
+            else:
+                header = None
+            try:
+                buffer = request.protocol.push(buffer, header)
+                request.done = request.protocol.is_terminated()
+            except Exception as e:
+                request.error = e
+                request.done = True
+                # Pass on any following response, including one that interrupted this one
+                header = RESPONSE_HEADER_REGEXP.search(buffer, 0 if resumed else 1)
+                buffer = buffer[header.start():] if header else ''
+            if request.done:
+                self._pending.popleft()
+
+
+class DTENUS():
+    """Synchronous interface to AsyncDTENUS over a BLEDevice"""
+
+    def __init__(self, device, write_without_response=False, depth=NUS_PIPELINE_DEPTH):
+        self._device = device
+        self._nus = AsyncDTENUS(device.async_device, write_without_response, depth=depth)
+
+    def send(self, data, timeout=6.0, on_frame=None):
+        return self._device._await_bleak(self._nus.send(data, timeout, on_frame))
+
+    def send_many(self, commands, timeout=6.0):
+        return self._device._await_bleak(self._nus.send_many(commands, timeout))
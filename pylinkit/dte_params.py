@@ -112,8 +112,6 @@ class DTEParamMap():
     [ "ALS_SENSOR_ENABLE_TX_MODE", "LTP04", SENSORTXENABLEMODE ],
     [ "ALS_SENSOR_ENABLE_TX_MAX_SAMPLES", "LTP05", UINT ],
     [ "ALS_SENSOR_ENABLE_TX_SAMPLE_PERIOD", "LTP06", UINT ],
-    [ "ALS_SENSOR_VALUE", "LTP03", FLOAT ],
-    [ "ALS_SENSOR_VALUE", "LTP03", FLOAT ],
     [ "CDT_SENSOR_ENABLE", "CDP01", BOOLEAN ],
     [ "CDT_SENSOR_PERIODIC", "CDP02", UINT ],
     [ "CDT_SENSOR_CONDUCTIVITY_VALUE", "CDP03", FLOAT ],
@@ -148,30 +146,36 @@ class DTEParamMap():
     [ "LB_CRITICAL_THRESH", "LBP12", FLOAT ],
     ]
 
+    # Indexes built once from param_map
+    param_index = { param: (key, cls) for (param, key, cls) in param_map }
+    key_index = { key: (param, cls) for (param, key, cls) in param_map }
+
     @staticmethod
     def param_to_key(p):
-        for (param, key, cls) in DTEParamMap.param_map:
-            if p == param:
-                return key
-        raise Exception('Param {} not found'.format(p))
+        try:
+            return DTEParamMap.param_index[p][0]
+        except KeyError:
+            raise Exception('Param {} not found'.format(p)) from None
 
     @staticmethod
     def key_to_param(k):
-        for (param, key, cls) in DTEParamMap.param_map:
-            if k == key:
-                return param
-        raise Exception('Key {} not found'.format(k))
+        try:
+            return DTEParamMap.key_index[k][0]
+        except KeyError:
+            raise Exception('Key {} not found'.format(k)) from None
 
     @staticmethod
     def decode(k, v):
-        for (_, key, cls) in DTEParamMap.param_map:
-            if k == key:
-                return cls.decode(v)
-        raise Exception('Key {} not found'.format(k))
+        try:
+            cls = DTEParamMap.key_index[k][1]
+        except KeyError:
+            raise Exception('Key {} not found'.format(k)) from None
+        return cls.decode(v)
 
     @staticmethod
     def encode(p, v):
-        for (param, _, cls) in DTEParamMap.param_map:
-            if p == param:
-                return cls.encode(v)
-        raise Exception('Param {} not found'.format(p))
+        try:
+            cls = DTEParamMap.param_index[p][1]
+        except KeyError:
+            raise Exception('Param {} not found'.format(p)) from None
+        return cls.encode(v)
@@ -105,7 +105,35 @@ class ARGOSFREQ():
         return (float(value) + ARGOSFREQ.ARGOS_FREQUENCY_OFFSET) / ARGOSFREQ.ARGOS_FREQUENCY_MULT
 
 
-class ARGOSPOWER():
+class ENUM():
+    """Encodes a value as its index in allowed via a reverse index built once per class"""
+    allowed = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.index = {}
+        for i, x in enumerate(cls.allowed):
+            cls.index.setdefault(x, i)
+
+    @classmethod
+    def encode(cls, value):
+        try:
+            return str(cls.index[value])
+        except KeyError:
+            raise ValueError('{} is not in {}'.format(value, cls.__name__)) from None
+
+    @classmethod
+    def decode(cls, value):
+        return cls.allowed[int(value)]
+
+
+class INTENUM(ENUM):
+    @classmethod
+    def encode(cls, value):
+        return super().encode(int(value))
+
+
+class ARGOSPOWER(INTENUM):
     """
     POWER_3_MW = 1,
     POWER_40_MW,
@@ -120,171 +148,59 @@ class ARGOSPOWER():
     """
     allowed = [-1, 3, 40, 200, 500, 5, 50, 350, 750, 1000, 1500]
 
-    @staticmethod
-    def encode(value):
-        return str(ARGOSPOWER.allowed.index(int(value)))
-
-    @staticmethod
-    def decode(value):
-        return ARGOSPOWER.allowed[int(value)]
-
 
-class UWDETECTSOURCE():
+class UWDETECTSOURCE(ENUM):
     allowed = ['SWS', 'PRESSURE_SENSOR', 'GNSS', 'SWS_GNSS']
 
-    @staticmethod
-    def encode(value):
-        return str(UWDETECTSOURCE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return UWDETECTSOURCE.allowed[int(value)]
-
 
-class SENSORTXENABLEMODE():
+class SENSORTXENABLEMODE(ENUM):
     allowed = ['OFF', 'ONESHOT', 'MEAN', 'MEDIAN']
 
-    @staticmethod
-    def encode(value):
-        return str(SENSORTXENABLEMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return SENSORTXENABLEMODE.allowed[int(value)]
-
 
-class ARGOSMODE():
+class ARGOSMODE(ENUM):
     allowed = ['OFF', 'PASS_PREDICTION', 'LEGACY', 'DUTY_CYCLE']
 
-    @staticmethod
-    def encode(value):
-        return str(ARGOSMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return ARGOSMODE.allowed[int(value)]
-
 
-class ARGOSMODEZONE():
+class ARGOSMODEZONE(ENUM):
     allowed = ['OFF', 'PASS_PREDICTION', 'LEGACY', 'DUTY_CYCLE']
 
-    @staticmethod
-    def encode(value):
-        return str(ARGOSMODEZONE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return ARGOSMODEZONE.allowed[int(value)]
-
 
-class ARGOSMODULATION():
+class ARGOSMODULATION(ENUM):
     allowed = ['A2', 'A3', 'A4']
 
-    @staticmethod
-    def encode(value):
-        return str(ARGOSMODULATION.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return ARGOSMODULATION.allowed[int(value)]
-
 
-class DEPTHPILE():
+class DEPTHPILE(INTENUM):
     allowed = [-1,1,2,3,4,-1,-1,-1,8,12,16,20,24]
 
-    @staticmethod
-    def encode(value):
-        return str(DEPTHPILE.allowed.index(int(value)))
-
-    @staticmethod
-    def decode(value):
-        return DEPTHPILE.allowed[int(value)]
-
 
-class AQPERIOD():
+class AQPERIOD(INTENUM):
     allowed = [0,10,15,30,60,120,360,720,1440]
 
-    @staticmethod
-    def encode(value):
-        return str(AQPERIOD.allowed.index(int(value)))
-
-    @staticmethod
-    def decode(value):
-        return AQPERIOD.allowed[int(value)]
-
 
-class LEDMODE():
+class LEDMODE(ENUM):
     allowed = ['OFF', '24HRS', -1, 'ALWAYS']
 
-    @staticmethod
-    def encode(value):
-        return str(LEDMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return LEDMODE.allowed[int(value)]
-
 
-class DEBUGMODE():
+class DEBUGMODE(ENUM):
     allowed = ['UART', 'BLE']
 
-    @staticmethod
-    def encode(value):
-        return str(DEBUGMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return DEBUGMODE.allowed[int(value)]
-
 
-class PRESSURESENSORLOGGINGMODE():
+class PRESSURESENSORLOGGINGMODE(ENUM):
     allowed = ['ALWAYS', 'UW_THRESHOLD']
 
-    @staticmethod
-    def encode(value):
-        return str(PRESSURESENSORLOGGINGMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return PRESSURESENSORLOGGINGMODE.allowed[int(value)]
-
 
-class ZONETYPE():
+class ZONETYPE(ENUM):
     allowed = [-1, 'CIRCLE']
 
-    @staticmethod
-    def encode(value):
-        return str(ZONETYPE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return ZONETYPE.allowed[int(value)]
-
 
-class GNSSFIXMODE():
+class GNSSFIXMODE(ENUM):
     allowed = [-1, '2D', '3D', 'AUTO']
 
-    @staticmethod
-    def encode(value):
-        return str(GNSSFIXMODE.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return GNSSFIXMODE.allowed[int(value)]
-
 
-class GNSSDYNMODEL():
+class GNSSDYNMODEL(ENUM):
     allowed = ['PORTABLE', -1, 'STATIONARY', 'PEDESTRIAN', 'AUTOMOTIVE', 'SEA', 'AIRBORNE_1G', 'AIRBORNE_2G', 'AIRBORNE_4G',
                'WRIST_WORN_WATCH', 'BIKE']
 
-    @staticmethod
-    def encode(value):
-        return str(GNSSDYNMODEL.allowed.index(value))
-
-    @staticmethod
-    def decode(value):
-        return GNSSDYNMODEL.allowed[int(value)]
-
 
 
 class dotdict(dict):
@@ -388,25 +304,94 @@ class LOGFILE():
                  'LOG_INFO',
                  'LOG_TRACE']
 
+    LOG_HEADER_FORMAT = '<BBHBBBBB'
+    LOG_HEADER_SIZE = 9
+    LOG_GPS_FORMAT = '<xHIHBBBBBBIiBBBBBddiiIIiiiifIfffff'
+    LOG_GPS_SIZE = 104
+    # Field names of LOG_GPS_FORMAT, None for reserved bytes
+    LOG_GPS_FIELDS = ['batt_voltage', 'iTOW', 'fix_year', 'fix_month', 'fix_day', 'fix_hour', 'fix_min', 'fix_sec',
+                      'valid', 'onTime', 'ttff', 'fixType', None, None, None, 'numSV', 'lon', 'lat', 'height', 'hMSL',
+                      'hAcc', 'vAcc', 'velN', 'velE', 'velD', 'gSpeed', 'headMot', 'sAcc', 'headAcc', 'pDOP', 'vDOP',
+                      'hDOP', 'headVeh']
+    _header_struct = struct.Struct(LOG_HEADER_FORMAT)
+    _gps_struct = struct.Struct(LOG_GPS_FORMAT)
+
     @staticmethod
-    def decode_log_gps(payload, r):
+    def decode_log_gps(payload, r, offset=0):
         r.batt_voltage, r.iTOW, r.fix_year, r.fix_month, r.fix_day, r.fix_hour, r.fix_min, r.fix_sec, r.valid, r.onTime, r.ttff, r.fixType, _, _, _, r.numSV, \
         r.lon, r.lat, r.height, r.hMSL, r.hAcc, r.vAcc, r.velN, r.velE, r.velD, r.gSpeed, r.headMot, \
         r.sAcc, r.headAcc, r.pDOP, r.vDOP, r.hDOP, r.headVeh = \
-            struct.unpack('<xHIHBBBBBBIiBBBBBddiiIIiiiifIfffff', payload[:104])
+            LOGFILE._gps_struct.unpack_from(payload, offset)
         return r
 
     @staticmethod
-    def decode(data):
-        records = []
-        while data:
+    def iter_decode(buffer):
+        """Lazily decodes records by walking a memoryview of buffer without copying it"""
+        view = memoryview(buffer)
+        end = len(view)
+        offset = 0
+        while offset < end:
             r = LOGRECORD()
-            r.day, r.month, r.year, r.hours, r.mins, r.secs, r.log_t, payload_size = struct.unpack('<BBHBBBBB', data[:9])
+            r.day, r.month, r.year, r.hours, r.mins, r.secs, r.log_t, payload_size = LOGFILE._header_struct.unpack_from(view, offset)
             r.log_t = LOGFILE.LOG_TYPES[r.log_t]
+            offset += LOGFILE.LOG_HEADER_SIZE
             if (r.log_t == 'LOG_GPS'):
-                LOGFILE.decode_log_gps(data[9:], r)
+                LOGFILE.decode_log_gps(view, r, offset)
             else:
-                r.message = data[9:9+payload_size].decode('ascii', errors='ignore')
-            records.append(r)
-            data = data[9+payload_size:]
-        return records
+                r.message = str(view[offset:offset+payload_size], 'ascii', 'ignore')
+            offset += payload_size
+            yield r
+
+    @staticmethod
+    def decode(data):
+        return list(LOGFILE.iter_decode(data))
+
+    @staticmethod
+    def locate_records(data):
+        """Returns the offsets and log type indexes of all complete records in a single pass"""
+        offsets = []
+        log_types = []
+        offset = 0
+        end = len(data)
+        while offset + LOGFILE.LOG_HEADER_SIZE <= end:
+            next_offset = offset + LOGFILE.LOG_HEADER_SIZE + data[offset+8]
+            if next_offset > end:
+                break
+            offsets.append(offset)
+            log_types.append(data[offset+7])
+            offset = next_offset
+        return offsets, log_types
+
+    @staticmethod
+    def gps_dtype():
+        """Returns the NumPy structured dtype of a LOG_GPS record including its header"""
+        import numpy as np
+        codes = {'B': 'u1', 'H': '<u2', 'I': '<u4', 'i': '<i4', 'f': '<f4', 'd': '<f8'}
+        names = ['day', 'month', 'year', 'hours', 'mins', 'secs']
+        formats = ['u1', 'u1', '<u2', 'u1', 'u1', 'u1']
+        offsets = [0, 1, 2, 4, 5, 6]
+        fmt = LOGFILE.LOG_GPS_FORMAT[2:]  # Skip byte order and leading pad byte
+        offset = LOGFILE.LOG_HEADER_SIZE + 1
+        for name, code in zip(LOGFILE.LOG_GPS_FIELDS, fmt):
+            if name:
+                names.append(name)
+                formats.append(codes[code])
+                offsets.append(offset)
+            offset += struct.calcsize('<' + code)
+        return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                         'itemsize': LOGFILE.LOG_HEADER_SIZE + LOGFILE.LOG_GPS_SIZE})
+
+    @staticmethod
+    def decode_gps_array(data):
+        """Decodes all LOG_GPS records into a NumPy structured array (requires numpy)"""
+        import numpy as np
+        dtype = LOGFILE.gps_dtype()
+        offsets, log_types = LOGFILE.locate_records(data)
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        offsets = np.array(offsets, dtype=np.intp)
+        log_types = np.array(log_types, dtype=np.uint8)
+        offsets = offsets[log_types == LOGFILE.LOG_TYPES.index('LOG_GPS')]
+        if offsets.size and buffer[offsets + 8].min() < LOGFILE.LOG_GPS_SIZE:
+            raise Exception('LOG_GPS record payload too short')
+        rows = buffer[offsets[:, None] + np.arange(dtype.itemsize)]
+        return np.ascontiguousarray(rows).view(dtype).reshape(-1)
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+class DUMPDCheckpoint():
+    """Records the progress of a DUMPD transfer into a file so that it can be resumed.
+
+    The checkpoint is persisted as JSON alongside the output file.  The firmware always
+    sends a log file from chunk zero, so on resume the chunks already written are skipped
+    without being decoded or written again.
+    """
+
+    SAVE_INTERVAL = 16
+    SUFFIX = '.ckpt'
+
+    def __init__(self, filename, identity):
+        self.filename = filename
+        self.path = filename + self.SUFFIX
+        self.identity = identity
+        self.chunk = 0
+        self.MMM = None
+        self.size = 0
+        self._load()
+        self.file = open(filename, 'r+b' if os.path.exists(filename) else 'wb')
+        self.file.truncate(self.size)
+        self.file.seek(self.size)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get('identity') != self.identity:
+            logger.warning('Discarding checkpoint for %s: identity mismatch', state.get('identity'))
+            return
+        if not os.path.exists(self.filename) or os.path.getsize(self.filename) < state['size']:
+            logger.warning('Discarding checkpoint: %s is shorter than checkpoint', self.filename)
+            return
+        self.chunk = state['chunk']
+        self.MMM = state['MMM']
+        self.size = state['size']
+        logger.info('Resuming DUMPD at chunk %u/%u (%u bytes)', self.chunk, self.MMM, self.size)
+
+    def _restart(self, MMM):
+        self.chunk = 0
+        self.MMM = MMM
+        self.size = 0
+        self.file.seek(0)
+        self.file.truncate()
+
+    def accept(self, mmm, MMM):
+        """Returns True if chunk mmm of MMM has not already been received"""
+        if mmm == 0 and MMM != self.MMM:
+            if self.MMM is not None:
+                logger.warning('Log file changed since checkpoint (%u -> %u chunks), restarting', self.MMM, MMM)
+            self._restart(MMM)
+        return mmm >= self.chunk
+
+    def write(self, data):
+        self.file.write(data)
+
+    def advance(self, mmm, size):
+        self.chunk = mmm + 1
+        self.size += size
+        if self.chunk % self.SAVE_INTERVAL == 0:
+            self.save()
+
+    def save(self):
+        self.file.flush()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'identity': self.identity, 'chunk': self.chunk, 'MMM': self.MMM, 'size': self.size}, f)
+        os.replace(tmp, self.path)
+
+    def complete(self):
+        """Marks the transfer as complete and removes the checkpoint file"""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        if not self.file.closed:
+            self.save()
+            self.file.close()
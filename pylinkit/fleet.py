@@ -0,0 +1,171 @@
+# Concurrent provisioning and firmware updates of a fleet of trackers from a single event loop
+
+import asyncio
+import logging
+import os
+import time
+from . import AsyncTracker
+from .ota_fw import ThrottledProgress
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_OTA_CONCURRENCY = 4
+DEFAULT_RETRIES = 2
+RETRY_BACKOFF = 10.0
+
+
+class FleetResult():
+    def __init__(self, address):
+        self.address = address
+        self.ok = False
+        self.error = None
+        self.mismatched = []
+        self.elapsed = 0.0
+        self.skipped = False
+        self.attempts = 1
+
+
+def read_addresses(value):
+    """Returns the addresses in a comma separated list or in a file of one address per line"""
+    if not os.path.exists(value):
+        return [x.strip() for x in value.split(',') if x.strip()]
+    with open(value) as f:
+        return [x.strip() for x in f if x.strip() and not x.startswith('#')]
+
+
+async def provision(address, param_values=None, paspw=None, tracker_factory=AsyncTracker, diff=False):
+    """Connects to one tracker, writes param_values and paspw then verifies param_values.
+    If diff is set then only the param_values that differ are written, and only those
+    are verified (by AsyncTracker.set).
+    """
+    result = FleetResult(address)
+    start = time.monotonic()
+    tracker = tracker_factory(address)
+    connected = False
+    try:
+        await tracker.connect()
+        connected = True
+        if param_values:
+            await tracker.set(param_values, diff)
+        if paspw:
+            await tracker.paspw(paspw)
+        if param_values and not diff:
+            result.mismatched = await tracker.verify(param_values)
+        result.ok = not result.mismatched
+    except Exception as e:
+        logger.error('%s: %s', address, e)
+        result.error = str(e) or e.__class__.__name__
+    finally:
+        if connected:
+            await tracker.disconnect()
+        result.elapsed = time.monotonic() - start
+    return result
+
+
+async def provision_fleet(addresses, param_values=None, paspw=None, concurrency=DEFAULT_CONCURRENCY,
+                          tracker_factory=AsyncTracker, on_result=None, diff=False):
+    """Provisions all addresses with at most concurrency devices in progress at once"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(address):
+        async with semaphore:
+            result = await provision(address, param_values, paspw, tracker_factory, diff)
+        if on_result:
+            on_result(result)
+        return result
+
+    return await asyncio.gather(*[run(x) for x in addresses])
+
+
+async def update_firmware(address, data, file_id=0, cache=None, tracker_factory=AsyncTracker, on_status=None,
+                          force=False, **kwargs):
+    """Connects to one tracker and sends it a firmware image, skipping it unless force is
+    set if cache (a FirmwareCache) knows the image to be current.  The image sent is
+    recorded in cache.  on_status(address, status) is called
+    as the update progresses.  Other arguments are as for AsyncTracker.firmware_update.
+    """
+    def status(text):
+        if on_status:
+            on_status(address, text)
+
+    result = FleetResult(address)
+    start = time.monotonic()
+    tracker = tracker_factory(address)
+    connected = False
+    try:
+        status('connecting')
+        await tracker.connect()
+        connected = True
+        if cache and not force:
+            version = await tracker.firmware_version()
+            cache.observe(address, version)
+            if cache.is_current(cache.fingerprint(data), version):
+                status('current')
+                result.ok = result.skipped = True
+                return result
+        status('sending')
+        progress = ThrottledProgress(lambda count, total: status('{}%'.format(100 * count // total)), interval=5.0,
+                                     percent=10)
+        if await tracker.firmware_update(data, file_id, progress=progress, cache=cache, **kwargs) is None:
+            raise Exception('Update refused')
+        status('done')
+        result.ok = True
+    except Exception as e:
+        logger.error('%s: %s', address, e)
+        result.error = str(e) or e.__class__.__name__
+        status('failed: ' + result.error)
+    finally:
+        if connected:
+            try:
+                await tracker.disconnect()
+            except Exception as e:
+                logger.warning('%s: disconnect failed: %s', address, e)
+        result.elapsed = time.monotonic() - start
+    return result
+
+
+async def update_fleet(addresses, data, file_id=0, cache=None, concurrency=DEFAULT_OTA_CONCURRENCY,
+                       retries=DEFAULT_RETRIES, backoff=RETRY_BACKOFF, tracker_factory=AsyncTracker,
+                       on_status=None, on_result=None, **kwargs):
+    """Sends a firmware image to all addresses with at most concurrency updates in progress
+    at once.  Most of an update is spent waiting for the device to verify the image, so
+    overlapping updates shortens the fleet update considerably.
+
+    A failed device is requeued up to retries times, waiting backoff seconds before the
+    first retry and doubling the wait each time.  It does not hold a slot while waiting.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(address):
+        attempt = 1
+        while True:
+            async with semaphore:
+                result = await update_firmware(address, data, file_id, cache, tracker_factory, on_status, **kwargs)
+            result.attempts = attempt
+            if result.ok or attempt > retries:
+                break
+            delay = backoff * 2 ** (attempt - 1)
+            if on_status:
+                on_status(address, 'retrying in {:.0f} s'.format(delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+        if on_result:
+            on_result(result)
+        return result
+
+    return await asyncio.gather(*[run(x) for x in addresses])
+
+
+def format_results(results):
+    lines = ['{:<20} {:<8} {:>8}  {}'.format('ADDRESS', 'RESULT', 'TIME(s)', 'DETAIL')]
+    for r in results:
+        detail = r.error or ('mismatched: ' + ','.join(r.mismatched) if r.mismatched else '')
+        if r.skipped:
+            detail = 'already current'
+        elif r.attempts > 1:
+            detail = '{} attempts{}'.format(r.attempts, ': ' + detail if detail else '')
+        lines.append('{:<20} {:<8} {:>8.1f}  {}'.format(r.address, 'OK' if r.ok else 'FAIL', r.elapsed, detail))
+    return '\n'.join(lines)
@@ -0,0 +1,78 @@
+# Local cache of firmware image fingerprints and the FW_APP_VERSION each image reports
+# once running, so that devices already running an image can be skipped.
+
+import hashlib
+import json
+import logging
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.pylinkit', 'firmware.json')
+
+
+class FirmwareCache():
+    """Maps image fingerprints to FW_APP_VERSION strings.
+
+    The version of an image is either registered explicitly or learnt: after an image is
+    sent to a device the device's previous version is remembered, and the next time the
+    device reports a different version that version is recorded for the image.
+    """
+
+    def __init__(self, filename=DEFAULT_CACHE_FILE):
+        self.filename = filename
+        self._images = {}
+        self._pending = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    state = json.load(f)
+                self._images = state['images']
+                self._pending = state['pending']
+            except (ValueError, KeyError) as e:
+                logger.warning('Ignoring invalid firmware cache %s: %s', filename, e)
+
+    @staticmethod
+    def fingerprint(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def version(self, fingerprint):
+        """Returns the FW_APP_VERSION of an image or None if it is not known"""
+        return self._images.get(fingerprint)
+
+    def register(self, fingerprint, version):
+        self._images[fingerprint] = version
+        self.save()
+
+    def observe(self, address, version):
+        """Records the version a device is running, learning the version of any image
+        previously sent to it if the device has since changed version.
+        """
+        pending = self._pending.pop(address, None)
+        if pending is None:
+            return
+        fingerprint, previous_version = pending
+        if version != previous_version:
+            self._images[fingerprint] = version
+        self.save()
+
+    def updated(self, address, fingerprint, previous_version):
+        """Records that an image was sent to a device running previous_version"""
+        self._pending[address] = [fingerprint, previous_version]
+        self.save()
+
+    def forget(self, address):
+        """Cancels learning from a device, e.g. after it was sent something else"""
+        if self._pending.pop(address, None) is not None:
+            self.save()
+
+    def is_current(self, fingerprint, version):
+        return self.version(fingerprint) == version
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump({'images': self._images, 'pending': self._pending}, f, indent=1)
+        os.replace(self.filename + '.tmp', self.filename)
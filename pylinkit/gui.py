@@ -25,7 +25,8 @@ from kivy.factory import Factory
 from kivy.properties import ObjectProperty
 from kivy.uix.image import AsyncImage
 from .utils import OrderedRawConfigParser, extract_firmware_file_from_dfu, extract_params_from_config_file
-from pylinkit import Tracker, Scanner
+from .ota_fw import ThrottledProgress
+from pylinkit import Tracker, Scanner, FirmwareCache
 
 
 logger = logging.getLogger(__name__)
@@ -288,7 +289,7 @@ class MainMenu(BoxLayout):
             self._fetch_device_config()
     def _fetch_device_config(self, cb=None):
         def fetch_params():
-            self._tracker.sync()
+            # Only stale params are read, see ParamCache
             return self._tracker.get()
         self._popup = Popup(title='Sync', content=Label(text=f'Fetching device config...'), auto_dismiss=True)
         self._popup.open()
@@ -345,7 +346,7 @@ class MainMenu(BoxLayout):
 
     def _disconnect_pressed(self, _):
         self._btn_disconnect.disabled = True
-        AsyncOperation(self._tracker._device.disconnect, self._on_disconnect)
+        AsyncOperation(self._tracker.disconnect, self._on_disconnect)
         self._popup = Popup(title='Device', content=Label(text=f'Disconnecting...'), auto_dismiss=True)
         self._popup.open()
 
@@ -379,16 +380,22 @@ class MainMenu(BoxLayout):
     def _fw_update_apply(self, path, filename):
         self._popup.dismiss()
         try:
-            self._popup = Popup(title="Firmware Update", content=Label(text=f'Applying update (this may take 4-5 minutes)...'),
-                                auto_dismiss=True)
+            label = Label(text=f'Applying update (this may take 4-5 minutes)...')
+            self._popup = Popup(title="Firmware Update", content=label, auto_dismiss=True)
             self._popup.open()
+
+            def on_progress(count, total):
+                # Called from the BLE thread so update the label on the Kivy thread
+                Clock.schedule_once(lambda _: setattr(label, 'text', f'Applying update: {100 * count // total}%'))
+
             if filename[0].endswith('.zip'):
                 data = extract_firmware_file_from_dfu(os.path.join(path, filename[0]))
             else:
                 with open(os.path.join(path, filename[0]), 'rb') as f:
                     data = f.read()
                     f.close()
-            AsyncOperation(self._tracker.firmware_update, self._on_fw_update_done, data)
+            AsyncOperation(self._tracker.firmware_update, self._on_fw_update_done, data,
+                           progress=ThrottledProgress(on_progress, interval=1.0), retries=3, cache=FirmwareCache())
         except Exception as e:
             self._popup.dismiss()
             p = Popup(title='Firmware Update', content=Label(text=f'Error: {e}'), auto_dismiss=True)
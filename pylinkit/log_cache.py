@@ -0,0 +1,102 @@
+import logging
+import os
+from .dte_types import LOGFILE
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.pylinkit', 'logs')
+
+
+class LogHarvest():
+    """DUMPD sink that compares a dump against the cached copy of the same log file and
+    keeps only the data appended since the last harvest.
+
+    If the dump does not start with the cached data (e.g. the log was erased) then the
+    whole dump is treated as new and replaces the cached copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cached_size = os.path.getsize(path) if os.path.exists(path) else 0
+        self._cached = open(path, 'rb') if self._cached_size else None
+        self._new = open(path + '.new', 'w+b')
+        self._offset = 0
+        self._diverged = False
+
+    def write(self, data):
+        view = memoryview(data)
+        if not self._diverged and self._offset < self._cached_size:
+            n = min(len(view), self._cached_size - self._offset)
+            if self._cached.read(n) == view[:n]:
+                self._offset += n
+                view = view[n:]
+            else:
+                logger.warning('%s differs from the device log, replacing it', self.path)
+                self._diverged = True
+        self._new.write(view)
+
+    def finish(self):
+        """Commits the harvest to the cache and returns the new log data"""
+        if self._offset < self._cached_size:
+            self._diverged = True
+        self._new.seek(0)
+        new_data = self._new.read()
+        if self._cached:
+            self._cached.seek(0)
+            prefix = self._cached.read(self._offset) if self._diverged else b''
+            self._cached.close()
+            self._cached = None
+        else:
+            prefix = b''
+        self._new.close()
+        os.remove(self.path + '.new')
+        if self._diverged:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(prefix)
+                f.write(new_data)
+            os.replace(self.path + '.tmp', self.path)
+            return prefix + new_data
+        with open(self.path, 'ab') as f:
+            f.write(new_data)
+        return new_data
+
+    def abort(self):
+        if self._cached:
+            self._cached.close()
+        self._new.close()
+        os.remove(self.path + '.new')
+
+
+class LogCache():
+    """Local per-device cache of harvested log files, keyed by device identity"""
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        self.root = root
+
+    def path(self, identity, log_type):
+        # Addresses are valid identities but ':' is not valid in all file systems
+        return os.path.join(self.root, str(identity).replace(':', '-'), '{}.bin'.format(log_type))
+
+    def load(self, identity, log_type):
+        """Returns all cached data for a device log file"""
+        path = self.path(identity, log_type)
+        if not os.path.exists(path):
+            return b''
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def harvest(self, tracker, log_type):
+        """Dumps a log file from the tracker and returns an iterator over the records that
+        are new since the last harvest.  Only new data is decoded and stored.
+        """
+        path = self.path(tracker.identity(), log_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        harvest = LogHarvest(path)
+        try:
+            tracker.dumpd(log_type, harvest)
+        except:
+            harvest.abort()
+            raise
+        return LOGFILE.iter_decode(harvest.finish())
@@ -0,0 +1,86 @@
+# Columnar binary export of decoded log files
+# Parquet export requires pyarrow and NPZ export requires numpy, both are optional.
+
+from .dte_types import LOGFILE
+
+
+ROW_GROUP_SIZE = 65536
+
+HEADER_FIELDS = [('day', 'B'), ('month', 'B'), ('year', 'H'), ('hours', 'B'), ('mins', 'B'), ('secs', 'B')]
+GPS_FIELDS = [(name, code) for name, code in zip(LOGFILE.LOG_GPS_FIELDS, LOGFILE.LOG_GPS_FORMAT[2:]) if name]
+
+
+def parquet_schema():
+    """Returns the pyarrow schema of an exported log file.  GPS fields are null for
+    message records and message is null for LOG_GPS records.
+    """
+    import pyarrow as pa
+    types = {'B': pa.uint8(), 'H': pa.uint16(), 'I': pa.uint32(), 'i': pa.int32(), 'f': pa.float32(), 'd': pa.float64()}
+    return pa.schema([(name, types[code]) for name, code in HEADER_FIELDS] +
+                     [('log_t', pa.dictionary(pa.int8(), pa.string())), ('message', pa.string())] +
+                     [(name, types[code]) for name, code in GPS_FIELDS])
+
+
+def export_parquet(data, filename, row_group_size=ROW_GROUP_SIZE):
+    """Writes the decoded records of a binary log file to Parquet, one row group per
+    row_group_size records.  Returns the number of records written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = parquet_schema()
+    names = schema.names
+    count = 0
+    with pq.ParquetWriter(filename, schema) as writer:
+        columns = {name: [] for name in names}
+        for r in LOGFILE.iter_decode(data):
+            for name in names:
+                columns[name].append(r.get(name))
+            count += 1
+            if count % row_group_size == 0:
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                columns = {name: [] for name in names}
+        if columns['log_t'] or count == 0:
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+    return count
+
+
+def export_npz(data, filename):
+    """Writes a binary log file to NPZ.  LOG_GPS records are stored as the 'gps' structured
+    array (see LOGFILE.decode_gps_array) and all other records as 'day', 'month', 'year',
+    'hours', 'mins', 'secs', 'log_t' and 'message' columns.  Returns the number of
+    records written.
+    """
+    import numpy as np
+    gps = LOGFILE.decode_gps_array(data)
+    columns = {name: [] for name, _ in HEADER_FIELDS}
+    columns['log_t'] = []
+    columns['message'] = []
+    for r in _iter_messages(data):
+        for name in columns:
+            columns[name].append(r[name])
+    dtypes = {'B': np.uint8, 'H': np.uint16}
+    arrays = {name: np.array(columns[name], dtype=dtypes[code]) for name, code in HEADER_FIELDS}
+    arrays['log_t'] = np.array(columns['log_t'], dtype=str)
+    arrays['message'] = np.array(columns['message'], dtype=str)
+    np.savez(filename, gps=gps, **arrays)
+    return len(gps) + len(columns['log_t'])
+
+
+def _iter_messages(data):
+    """Decodes only the non LOG_GPS records of a binary log file"""
+    view = memoryview(data)
+    offsets, log_types = LOGFILE.locate_records(view)
+    gps = LOGFILE.LOG_TYPES.index('LOG_GPS')
+    for offset, log_t in zip(offsets, log_types):
+        if log_t != gps:
+            payload_size = view[offset+8]
+            yield next(LOGFILE.iter_decode(view[offset:offset+LOGFILE.LOG_HEADER_SIZE+payload_size]))
+
+
+def export(data, filename, **kwargs):
+    """Exports a binary log file to Parquet or NPZ according to the filename extension"""
+    if filename.endswith('.parquet'):
+        return export_parquet(data, filename, **kwargs)
+    if filename.endswith('.npz'):
+        return export_npz(data, filename)
+    raise Exception('Unsupported export format: {}'.format(filename))
@@ -0,0 +1,124 @@
+# Streaming transcoding of binary log files to JSON, JSON lines or CSV
+
+import csv
+import json
+import mmap
+from .dte_types import LOGFILE
+
+
+FORMATS = ['bin', 'json', 'jsonl', 'csv']
+
+HEADER_FIELDS = ['day', 'month', 'year', 'hours', 'mins', 'secs', 'log_t']
+MESSAGE_FIELDS = HEADER_FIELDS + ['message']
+GPS_FIELDS = HEADER_FIELDS + [x for x in LOGFILE.LOG_GPS_FIELDS if x]
+
+
+def format_from_filename(filename):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    return extension if extension in FORMATS else 'bin'
+
+
+class JSONArrayWriter():
+    def __init__(self, fp):
+        self._fp = fp
+        self._first = True
+        fp.write('[')
+
+    def write(self, r):
+        record = json.dumps(r, indent=4, sort_keys=True).replace('\n', '\n    ')
+        self._fp.write('\n    ' + record if self._first else ',\n    ' + record)
+        self._first = False
+
+    def close(self):
+        self._fp.write('\n]\n')
+
+
+class JSONLinesWriter():
+    def __init__(self, fp):
+        self._fp = fp
+
+    def write(self, r):
+        self._fp.write(json.dumps(r, sort_keys=True) + '\n')
+
+    def close(self):
+        pass
+
+
+class CSVWriter():
+    """Columns are chosen by the first record: GPS fields for LOG_GPS logs, otherwise message"""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._writer = None
+
+    def write(self, r):
+        if self._writer is None:
+            fieldnames = GPS_FIELDS if r.log_t == 'LOG_GPS' else MESSAGE_FIELDS
+            self._writer = csv.DictWriter(self._fp, fieldnames=fieldnames, extrasaction='ignore')
+            self._writer.writeheader()
+        self._writer.writerow(r)
+
+    def close(self):
+        pass
+
+
+WRITERS = {'json': JSONArrayWriter, 'jsonl': JSONLinesWriter, 'csv': CSVWriter}
+
+
+class LogStreamDecoder():
+    """DUMPD sink that decodes records as soon as they are complete and passes each one
+    to a writer.  Only a partial trailing record is buffered between chunks.
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._buffer = bytearray()
+        self.count = 0
+
+    def write(self, data):
+        self._buffer += data
+        offsets, _ = LOGFILE.locate_records(self._buffer)
+        if not offsets:
+            return
+        end = offsets[-1] + LOGFILE.LOG_HEADER_SIZE + self._buffer[offsets[-1]+8]
+        with memoryview(self._buffer) as view:
+            for r in LOGFILE.iter_decode(view[:end]):
+                self._writer.write(r)
+                self.count += 1
+        del self._buffer[:end]
+
+    def close(self):
+        if self._buffer:
+            raise Exception('Log file ends with a truncated record of {} bytes'.format(len(self._buffer)))
+        self._writer.close()
+
+
+def open_writer(fp, fmt):
+    return WRITERS[fmt](fp)
+
+
+def transcode(data, fp, fmt):
+    """Transcodes binary log file data to fp in the given format and returns the record count"""
+    writer = open_writer(fp, fmt)
+    count = 0
+    for r in LOGFILE.iter_decode(data):
+        writer.write(r)
+        count += 1
+    writer.close()
+    return count
+
+
+def transcode_file(input_filename, output_filename, fmt=None):
+    """Transcodes an existing binary log file, memory mapped so memory use stays flat"""
+    fmt = fmt or format_from_filename(output_filename)
+    with open(input_filename, 'rb') as f, open(output_filename, 'w', newline='') as fp:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be memory mapped
+            data = b''
+        try:
+            return transcode(data, fp, fmt)
+        finally:
+            if data:
+                data.close()
@@ -1,7 +1,11 @@
-import struct, time
-from threading import Event
+import asyncio
+import struct
+import time
+import zlib
+from collections import namedtuple
 
 OTA_CHAR_LENGTH = 20
+OTA_WRITE_WINDOW = 16
 OTA_BASE_ADDR_CHAR_UUID = '0000FE22-8E22-4541-9D4C-21EDAE82ED19'
 OTA_STATUS_CHAR_UUID = '0000FE23-8E22-4541-9D4C-21EDAE82ED19'
 OTA_RAW_DATA_UUID = '0000FE24-8E22-4541-9D4C-21EDAE82ED19'
@@ -9,53 +13,182 @@ OTA_RAW_DATA_UUID = '0000FE24-8E22-4541-9D4C-21EDAE82ED19'
 ACTION_START = 1
 ACTION_DONE = 7
 ACTION_ABORT = 8
+# Not part of the START/DONE/ABORT protocol, only sent to firmware known to support it
+ACTION_RESUME = 9
 
 DEFAULT_TIMEOUT = 20 * 60
+RESUME_TIMEOUT = 5.0
+# Time allowed after the image transfer ACK for the device to clean up
+CLEANUP_DELAY = 3.0
 
-class OTAFW():
-    def __init__(self, device):
+
+class OTAInterrupted(Exception):
+    """The link failed during the data phase, offset bytes had been acknowledged"""
+
+    def __init__(self, offset, error):
+        super().__init__('OTA interrupted at offset {}: {}'.format(offset, error))
+        self.offset = offset
+        self.error = error
+
+
+class OTAReport(namedtuple('OTAReport', ['size', 'elapsed', 'writes'])):
+    """Throughput of the data phase of an OTA transfer"""
+
+    @property
+    def rate(self):
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return '{} bytes in {} writes took {:.1f} s ({:.0f} bytes/sec)'.format(self.size, self.writes, self.elapsed, self.rate)
+
+
+def print_progress(count, total):
+    print(count, '/', total, end = '\r')
+
+
+class ThrottledProgress():
+    """Wraps a progress callback(count, total) so that it is called at most once every
+    interval seconds or percent of the total, and always on completion.
+    """
+
+    def __init__(self, callback=print_progress, interval=0.5, percent=1.0):
+        self._callback = callback
+        self._interval = interval
+        self._percent = percent
+        self._last_time = None
+        self._last_count = 0
+
+    def __call__(self, count, total):
+        now = time.monotonic()
+        if count < total and self._last_time is not None and now - self._last_time < self._interval and \
+                100 * (count - self._last_count) < self._percent * total:
+            return
+        self._last_time = now
+        self._last_count = count
+        self._callback(count, total)
+
+
+class AsyncOTAFW():
+
+    def __init__(self, device, cleanup_delay=CLEANUP_DELAY):
         self._device = device
-        self._event = Event()
+        self._cleanup_delay = cleanup_delay
+        self._event = None
         self._status = 0
-        device.subscribe(OTA_STATUS_CHAR_UUID, self._status_handler)
+        self._subscribed = False
+        self._transfer = None
+        self.acknowledged = 0
+
+    def reset(self):
+        """Must be called after the connection is re-established so that the status
+        characteristic is subscribed again.  The resume point is kept.
+        """
+        self._subscribed = False
 
-    def send_update_file(self, file_id, data, timeout):
+    async def _start(self, file_id, key, resume):
+        """Performs the START handshake and returns the offset to send from.  If resume is
+        set and the same image was interrupted then the device is first asked to resume
+        from the acknowledged offset, falling back to a full START if it refuses.
+        """
+        if resume and self._transfer == key and self.acknowledged:
+            self._status = 0
+            self._event = asyncio.Event()
+            try:
+                # Devices without ACTION_RESUME may reject the longer write outright
+                await self._device.char_write(OTA_BASE_ADDR_CHAR_UUID,
+                                              struct.pack('<II', ACTION_RESUME | file_id << 8, self.acknowledged))
+            except Exception as e:
+                print('RESUME request failed:', e)
+            else:
+                print('Waiting for device to ACK our RESUME request at offset', self.acknowledged)
+                if await self._wait(RESUME_TIMEOUT) and self._status == 0:
+                    print('Received ACK, resuming....')
+                    return self.acknowledged
+            print('Resume not possible, restarting....')
+        self._transfer = key
+        self.acknowledged = 0
         self._status = 0
-        action = ACTION_START | file_id << 8
-        self._event.clear()
-        self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', action))
+        self._event = asyncio.Event()
+        await self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_START | file_id << 8))
         print('Waiting for device to ACK our START request')
-        is_set = self._event.wait(15.0)
-        total_length = len(data)
-        count = 0
-        if is_set is False:
+        if await self._wait(15.0) is False:
             raise Exception('Time out waiting for START handshake')
-        if self._status == 0:
-            print('Received ACK, sending data....')
-        else:
+        if self._status != 0:
             print('Received NACK, aborting....')
+            return None
+        print('Received ACK, sending data....')
+        return 0
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def send_update_file(self, file_id, data, timeout, write_without_response=False, window=OTA_WRITE_WINDOW,
+                               progress=None, resume=False):
+        """Sends a firmware image and returns an OTAReport, or None if the device refused it.
+        progress(count, total) is called as data is sent, by default a ThrottledProgress
+        printing to the console.
+
+        If the link fails while sending data then OTAInterrupted is raised.  Calling again
+        after reconnecting (and reset()) sends the image again from the start, or with
+        resume set, for firmware that supports ACTION_RESUME, continues the same image from
+        the last acknowledged offset if the device accepts it.
+
+        By default the image is sent in acknowledged OTA_CHAR_LENGTH writes.  If
+        write_without_response is set then the image is sent in MTU-3 byte writes without
+        response, with every window'th write acknowledged to apply backpressure.
+        """
+        if not self._subscribed:
+            await self._device.subscribe(OTA_STATUS_CHAR_UUID, self._status_handler)
+            self._subscribed = True
+        total_length = len(data)
+        offset = await self._start(file_id, (file_id, total_length, zlib.crc32(data)), resume)
+        if offset is None:
             return
-        for x in [ data[0+i:OTA_CHAR_LENGTH+i] for i in range(0, len(data), OTA_CHAR_LENGTH) ]:
-            self._device.char_write(OTA_RAW_DATA_UUID, x)
+        size = max(OTA_CHAR_LENGTH, self._device.mtu_size - 3) if write_without_response else OTA_CHAR_LENGTH
+        progress = progress or ThrottledProgress()
+        view = memoryview(data)
+        count = offset
+        writes = 0
+        start = time.monotonic()
+        for i in range(offset, total_length, size):
+            x = view[i:i+size]
+            writes += 1
             count += len(x)
-            print(count, '/', total_length, end = '\r')
+            response = not write_without_response or writes % window == 0 or count == total_length
+            try:
+                await self._device.char_write(OTA_RAW_DATA_UUID, x, response)
+            except Exception as e:
+                raise OTAInterrupted(self.acknowledged, e) from e
+            if response:
+                self.acknowledged = count
+            progress(count, total_length)
             if self._status:
                 print('Aborted remotely')
-                self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_ABORT))
+                self._transfer = None
+                await self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_ABORT))
                 return
-        self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_DONE))
-        print('Data has been submitted...')
+        report = OTAReport(total_length - offset, time.monotonic() - start, writes)
+        self._transfer = None
+        self._event.clear()
+        await self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_DONE))
+        print('Data has been submitted...', report)
         print('Waiting for image transfer ACK...this may take some time...CTRL-C to abort')
-        is_set = self._event.wait(timeout or DEFAULT_TIMEOUT)
+        is_set = await self._wait(timeout or DEFAULT_TIMEOUT)
         if is_set is False:
             # Abort pending OTA update
-            self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_ABORT))
+            await self._device.char_write(OTA_BASE_ADDR_CHAR_UUID, struct.pack('<I', ACTION_ABORT))
             raise Exception('Time out waiting for STATUS handshake')
         if (self._status == 0):
             print('Image transfer ACK')
-            time.sleep(3)  # Allow time for procedure to clean up
+            await asyncio.sleep(self._cleanup_delay)  # Allow time for procedure to clean up
         else:
             print('Image transfer NACK')
+            return None
+        return report
 
     def _status_handler(self, _, data):
         # File Upload Status is 3 bytes:
@@ -68,5 +201,18 @@ class OTAFW():
             self._status = int(data[1])
         elif int(data[2]) != 0xFF:
             self._status = int(data[2])
-        self._event.set()
-        self._event.clear()
+        if self._event:
+            self._event.set()
+
+
+class OTAFW():
+    """Synchronous interface to AsyncOTAFW over a BLEDevice"""
+
+    def __init__(self, device, cleanup_delay=CLEANUP_DELAY):
+        self._device = device
+        self._otafw = AsyncOTAFW(device.async_device, cleanup_delay)
+
+    def send_update_file(self, file_id, data, timeout, write_without_response=False, window=OTA_WRITE_WINDOW,
+                         progress=None, resume=False):
+        return self._device._await_bleak(self._otafw.send_update_file(file_id, data, timeout, write_without_response,
+                                                                      window, progress, resume))
@@ -0,0 +1,65 @@
+# Cache of tracker param values with an expiry policy per class of param
+
+import time
+from .dte_params import DTEParamMap
+
+
+IDENTITY = 'identity'
+CONFIG = 'config'
+STATUS = 'status'
+
+STATUS_TTL = 5.0
+
+
+def param_class(param):
+    """Classifies a param by its key: IDTxx keys identify the device, other keys with a
+    'T' third character are read only status and the rest are configuration.
+    """
+    key = DTEParamMap.param_to_key(param)
+    if key[2] != 'T':
+        return CONFIG
+    return IDENTITY if key.startswith('IDT') else STATUS
+
+
+class ParamCache():
+    """Param values read from a tracker.  Identity params never expire, config params
+    expire only when invalidated (e.g. after they are written) and status params expire
+    status_ttl seconds after they were read.
+    """
+
+    def __init__(self, status_ttl=STATUS_TTL):
+        self.status_ttl = status_ttl
+        self.complete = False
+        self._values = {}
+        self._read_at = {}
+
+    def update(self, values, complete=False):
+        now = time.monotonic()
+        self._values.update(values)
+        self._read_at.update(dict.fromkeys(values, now))
+        self.complete = self.complete or complete
+
+    def invalidate(self, params=None, classes=None):
+        """Expires the given params, or all params of the given classes, or everything.
+        Expired params stay known so that they are read again on the next refresh.
+        """
+        if params is None:
+            params = [p for p in self._values if classes is None or param_class(p) in classes]
+        for p in params:
+            self._read_at[p] = None
+
+    def is_stale(self, param):
+        read_at = self._read_at.get(param)
+        if read_at is None:
+            return True
+        cls = param_class(param)
+        return cls == STATUS and time.monotonic() - read_at > self.status_ttl
+
+    def stale(self, params=None):
+        return [p for p in (self._values if params is None else params) if self.is_stale(p)]
+
+    def get(self, attr=None):
+        return self._values[attr] if attr else dict(self._values)
+
+    def keys(self):
+        return self._values.keys()
@@ -0,0 +1,85 @@
+# Persistent registry of previously seen trackers, so that a tracker can be found by its
+# identity without scanning and reconnected without rediscovering it.
+
+import json
+import logging
+import os
+import re
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_REGISTRY_FILE = os.path.join(os.path.expanduser('~'), '.pylinkit', 'devices.json')
+
+IDENTITY_PARAMS = ['DEVICE_DECID', 'ARGOS_DECID', 'ARGOS_HEXID', 'DEVICE_MODEL', 'HW_VERSION', 'FW_APP_VERSION']
+
+ADDRESS_REGEXP = re.compile('^([0-9A-Fa-f]{2}[:-]){5}[0-9A-Fa-f]{2}$|^[0-9A-Fa-f]{8}-([0-9A-Fa-f]{4}-){3}[0-9A-Fa-f]{12}$')
+
+
+class DeviceRegistry():
+    """Trackers keyed by address with their name, last RSSI, last seen time (seconds
+    since the epoch) and identity params (IDENTITY_PARAMS) as last read.
+
+    Device handles found by scanning are also kept for the life of the process, so that
+    connecting to them does not need another discovery scan.
+    """
+
+    def __init__(self, filename=DEFAULT_REGISTRY_FILE):
+        self.filename = filename
+        self._devices = {}
+        self._handles = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self._devices = json.load(f)
+            except ValueError as e:
+                logger.warning('Ignoring invalid device registry %s: %s', filename, e)
+
+    def seen(self, device, rssi=None):
+        """Records a device found by scanning"""
+        self._handles[device.address] = device
+        entry = self._devices.setdefault(device.address, {})
+        entry.update(name=device.name, rssi=rssi, last_seen=time.time())
+        self.save()
+
+    def identified(self, address, values):
+        """Records the identity params among values read from a device"""
+        entry = self._devices.setdefault(address, {})
+        entry.update({p: values[p] for p in IDENTITY_PARAMS if p in values})
+        entry['last_seen'] = time.time()
+        self.save()
+
+    def handle(self, address):
+        """Returns the device handle found by a scan in this process, if any"""
+        return self._handles.get(address)
+
+    def get(self, address):
+        return self._devices.get(address, {})
+
+    def devices(self):
+        return dict(self._devices)
+
+    def lookup(self, key):
+        """Returns the address of a device given its address, DEVICE_DECID, ARGOS_DECID,
+        ARGOS_HEXID or name, or None if no such device is known
+        """
+        if key in self._devices or ADDRESS_REGEXP.match(key):
+            return key
+        try:
+            decid = int(key, 0)
+        except ValueError:
+            decid = None
+        for address, entry in self._devices.items():
+            if decid and decid in (entry.get('DEVICE_DECID'), entry.get('ARGOS_DECID')):
+                return address
+            if key.upper() == str(entry.get('ARGOS_HEXID', '')).upper() or key == entry.get('name'):
+                return address
+        return None
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(self._devices, f, indent=1, sort_keys=True)
+        os.replace(self.filename + '.tmp', self.filename)
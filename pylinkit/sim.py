@@ -0,0 +1,333 @@
+# Loopback/simulated LinkIt BLE backend
+# This provides drop-in replacements for AsyncBLEDevice and BLEDevice that emulate the
+# NUS and OTA characteristics of a LinkIt tag so that the DTE, DTENUS and OTAFW stack
+# can be exercised without any hardware.
+
+import binascii
+import logging
+import asyncio
+import random
+import struct
+import time
+from .ble import BLEDevice, BluetoothError, DEFAULT_MTU
+from .dte_nus import NUS_RX_CHAR_UUID, NUS_TX_CHAR_UUID
+from .ota_fw import OTA_BASE_ADDR_CHAR_UUID, OTA_STATUS_CHAR_UUID, OTA_RAW_DATA_UUID, ACTION_START, ACTION_DONE, ACTION_ABORT, \
+    ACTION_RESUME
+from .dte_params import DTEParamMap
+from .dte_types import BASE64, TEXT, UPPERCASETEXT, DATESTRING, LOGFILE
+
+
+logger = logging.getLogger(__name__)
+
+
+DUMPD_CHUNK_SIZE = 256
+
+DUMPD_LOG_TYPES = {0: 'system', 1: 'sensor', 2: 'als', 3: 'ph', 4: 'rtd', 5: 'cdt', 6: 'axl', 7: 'pressure'}
+ERASE_LOG_TYPES = {1: ['sensor'], 2: ['system'], 3: list(DUMPD_LOG_TYPES.values()), 4: ['als'], 5: ['ph'],
+                   6: ['rtd'], 7: ['cdt'], 8: ['axl'], 9: ['pressure']}
+
+GPS_PAYLOAD_FORMAT = '<xHIHBBBBBBIiBBBBBddiiIIiiiifIfffff'
+
+
+def make_log_record(log_t, payload, day=1, month=3, year=2021, hours=13, mins=26, secs=31):
+    return struct.pack('<BBHBBBBB', day, month, year, hours, mins, secs,
+                       LOGFILE.LOG_TYPES.index(log_t), len(payload)) + payload
+
+
+def make_gps_log(count):
+    data = bytearray()
+    for i in range(count):
+        secs = i % 60
+        payload = struct.pack(GPS_PAYLOAD_FORMAT, 4200, 134807995 + i * 1000, 2021, 3, 1, 13, 26, secs, 1,
+                              1000, 30000, 3, 0, 0, 0, 6, -2.1183726, 51.3767097, 48232, 240, 18700, 4116,
+                              1, -3, 0, 4, 0.0, 263, 180.0, 1.68, 0.96, 1.38, 0.0)
+        data += make_log_record('LOG_GPS', payload, secs=secs)
+    return bytes(data)
+
+
+def make_system_log(count):
+    data = bytearray()
+    for i in range(count):
+        message = 'GPSScheduler::schedule_aquisition in {} seconds'.format(i).encode('ascii')
+        data += make_log_record('LOG_INFO', message, secs=i % 60)
+    return bytes(data)
+
+
+def _default_value(param, cls):
+    if hasattr(cls, 'allowed'):
+        return str([i for i, x in enumerate(cls.allowed) if x != -1][0])
+    if cls in (TEXT, UPPERCASETEXT):
+        return param.split('_')[0]
+    if cls is DATESTRING:
+        return 'Mon Mar  1 13:26:31 2021'
+    return '0'
+
+
+class SimulatedAdvertisement():
+    def __init__(self, address, name, rssi=-60):
+        self.address = address
+        self.name = name
+        self.rssi = rssi
+
+
+class SimulatedFirmware():
+    """Emulates the DTE command handling of the LinkIt firmware.
+
+    Parameter values are held in their wire (encoded) form keyed by DTE key.
+    """
+
+    def __init__(self, logs=None, dumpd_chunk_size=DUMPD_CHUNK_SIZE):
+        self.params = {key: _default_value(param, cls) for (param, key, cls) in DTEParamMap.param_map}
+        self.params[DTEParamMap.param_to_key('DEVICE_MODEL')] = 'LinkIt'
+        self.params[DTEParamMap.param_to_key('FW_APP_VERSION')] = 'V3.4.1'
+        self.params[DTEParamMap.param_to_key('DEVICE_DECID')] = '1234'
+        self.logs = {x: b'' for x in DUMPD_LOG_TYPES.values()}
+        self.logs.update(logs or {})
+        self.paspw = None
+        self.dumpd_chunk_size = dumpd_chunk_size
+        self.resets = 0
+
+    @staticmethod
+    def _ok(cmd, payload=''):
+        return '$O;{cmd}#{length:03x};{payload}\r'.format(cmd=cmd, length=len(payload), payload=payload)
+
+    @staticmethod
+    def _nok(cmd, error):
+        return '$N;{cmd}#{length:03x};{error}\r'.format(cmd=cmd, length=len(str(error)), error=error)
+
+    def _status_keys(self):
+        return [key for (_, key, _) in DTEParamMap.param_map if key[2] == 'T' and key in self.params]
+
+    def _config_keys(self):
+        return [key for (_, key, _) in DTEParamMap.param_map if key[2] != 'T' and key in self.params]
+
+    def _read(self, cmd, payload, default_keys):
+        keys = payload.split(',') if payload else default_keys
+        keys = list(dict.fromkeys(keys))
+        if any(k not in self.params for k in keys):
+            return [self._nok(cmd, 3)]
+        return [self._ok(cmd, ','.join(['{}={}'.format(k, self.params[k]) for k in keys]))]
+
+    def _write(self, cmd, payload):
+        updates = {}
+        for x in payload.split(','):
+            key, _, value = x.partition('=')
+            if key not in self.params:
+                return [self._nok(cmd, 3)]
+            updates[key] = value
+        self.params.update(updates)
+        return [self._ok(cmd)]
+
+    def _dumpd(self, cmd, payload):
+        log_type = DUMPD_LOG_TYPES.get(int(payload or '0'))
+        if log_type is None:
+            return [self._nok(cmd, 3)]
+        data = self.logs[log_type]
+        chunks = [data[i:i+self.dumpd_chunk_size] for i in range(0, len(data), self.dumpd_chunk_size)] or [b'']
+        last = len(chunks) - 1
+        return [self._ok(cmd, '{:x},{:x},{}'.format(i, last, BASE64.encode(x).decode('ascii')))
+                for i, x in enumerate(chunks)]
+
+    def _erase(self, cmd, payload):
+        for log_type in ERASE_LOG_TYPES.get(int(payload or '0'), []):
+            self.logs[log_type] = b''
+        return [self._ok(cmd)]
+
+    def handle(self, command):
+        """Process a single '$CMD#LLL;payload' request and return the list of response frames"""
+        try:
+            header, _, payload = command.partition(';')
+            cmd, _, length = header[1:].partition('#')
+            if len(payload) != int(length, 16):
+                return [self._nok(cmd, 1)]
+        except ValueError:
+            return [self._nok('UNKNOWN', 1)]
+        if cmd == 'PARMR':
+            return self._read(cmd, payload, self._config_keys())
+        if cmd == 'STATR':
+            return self._read(cmd, payload, self._status_keys())
+        if cmd == 'PARMW':
+            return self._write(cmd, payload)
+        if cmd == 'DUMPD':
+            return self._dumpd(cmd, payload)
+        if cmd == 'ERASE':
+            return self._erase(cmd, payload)
+        if cmd == 'PASPW':
+            self.paspw = BASE64.decode(payload)
+            return [self._ok(cmd)]
+        if cmd in ('FACTW', 'RSTBW', 'RSTVW'):
+            self.resets += 1
+            return [self._ok(cmd)]
+        return [self._nok(cmd, 2)]
+
+
+class AsyncSimulatedBLEDevice(object):
+    """Drop-in replacement for AsyncBLEDevice backed by a SimulatedFirmware.
+
+    Notifications are delivered in order from a dispatcher task on the event loop,
+    chunked to MTU-3 bytes.  Each notification is delayed by latency seconds and
+    dropped with probability loss.  Each acknowledged char_write takes write_latency
+    seconds, writes without response return immediately.
+
+    If drop_after is set then the link drops once after that many OTA data writes.  An
+    interrupted OTA transfer survives the disconnect and may be resumed only if
+    ota_resume is set.
+    """
+
+    def __init__(self, firmware=None, mtu=DEFAULT_MTU, latency=0.0, write_latency=0.0, loss=0.0,
+                 ota_verify_delay=0.0, address='00:00:00:00:00:01', name='Linkit-Sim', seed=None,
+                 drop_after=None, ota_resume=False):
+        self.firmware = firmware or SimulatedFirmware()
+        self.mtu = mtu
+        self.latency = latency
+        self.write_latency = write_latency
+        self.loss = loss
+        self.ota_verify_delay = ota_verify_delay
+        self.drop_after = drop_after
+        self.ota_resume = ota_resume
+        self.address = address
+        self.name = name
+        self.ota_image = None
+        self.ota_file_id = None
+        self._random = random.Random(seed)
+        self._connected = False
+        self._callbacks = {}
+        self._rx_buffer = ''
+        self._ota_data = bytearray()
+        self._ota_active = False
+        self._queue = None
+        self._dispatcher = None
+        self._last_delivery = 0.0
+
+    async def scan(self, interval=None):
+        return [SimulatedAdvertisement(self.address, self.name)]
+
+    def rssi(self, address):
+        return -60
+
+    async def scan_stream(self, interval=None, accept=None):
+        for x in await self.scan(interval):
+            if accept is None or accept(x):
+                yield x
+
+    async def connect(self, address, timeout: float):
+        if self._connected:
+            raise Exception('Device already connected')
+        self._connected = True
+        self._queue = asyncio.Queue()
+        self._dispatcher = asyncio.ensure_future(self._run_dispatcher())
+        return self
+
+    async def disconnect(self):
+        self._connected = False
+        self._callbacks = {}
+        self._rx_buffer = ''
+        if not self.ota_resume:
+            self._ota_active = False
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    @property
+    def mtu_size(self):
+        return self.mtu
+
+    async def char_write(self, uuid, value, response=True):
+        if not self._connected:
+            raise Exception('Not connected')
+        value = bytes(value)
+        if len(value) > self.mtu - 3:
+            raise Exception('Write of {} bytes exceeds MTU {}'.format(len(value), self.mtu))
+        if response and self.write_latency:
+            await asyncio.sleep(self.write_latency)
+        uuid = uuid.upper()
+        if uuid == NUS_RX_CHAR_UUID:
+            self._nus_write(value.decode('ascii'))
+        elif uuid == OTA_BASE_ADDR_CHAR_UUID:
+            self._ota_action(*struct.unpack('<I' if len(value) == 4 else '<II', value))
+        elif uuid == OTA_RAW_DATA_UUID:
+            if self.drop_after is not None:
+                self.drop_after -= 1
+                if self.drop_after < 0:
+                    self.drop_after = None
+                    await self.disconnect()
+                    raise BluetoothError('Link dropped')
+            if self._ota_active:
+                self._ota_data += value
+        else:
+            raise Exception('Characteristic {} not writable'.format(uuid))
+
+    async def char_read(self, uuid):
+        raise Exception('Characteristic {} not readable'.format(uuid))
+
+    async def subscribe(self, uuid, callback):
+        self._callbacks[uuid.upper()] = callback
+
+    def _nus_write(self, data):
+        self._rx_buffer += data
+        while '\r' in self._rx_buffer:
+            command, _, self._rx_buffer = self._rx_buffer.partition('\r')
+            logger.debug('SIM <- PC: %s', command)
+            for frame in self.firmware.handle(command):
+                self._notify_frame(NUS_TX_CHAR_UUID, frame.encode('ascii'))
+
+    def _ota_action(self, action, offset=0):
+        if (action & 0xFF) == ACTION_START:
+            self._ota_data = bytearray()
+            self._ota_active = True
+            self.ota_file_id = action >> 8
+            self._notify(OTA_STATUS_CHAR_UUID, bytes([0xFF, 0xFF, 0]))
+        elif (action & 0xFF) == ACTION_RESUME:
+            ok = self.ota_resume and self._ota_active and self.ota_file_id == action >> 8 and offset <= len(self._ota_data)
+            if ok:
+                del self._ota_data[offset:]
+            self._notify(OTA_STATUS_CHAR_UUID, bytes([0xFF, 0xFF, 0 if ok else 1]))
+        elif action == ACTION_DONE and self._ota_active:
+            self._ota_active = False
+            data = bytes(self._ota_data)
+            length, crc = struct.unpack('>II', data[:8]) if len(data) >= 8 else (None, None)
+            ok = length == len(data) - 8 and crc == binascii.crc32(data[8:])
+            if ok:
+                self.ota_image = data
+            self._notify(OTA_STATUS_CHAR_UUID, bytes([0xFF, 0 if ok else 1, 0xFF]), self.ota_verify_delay)
+        elif action == ACTION_ABORT:
+            self._ota_active = False
+            self._ota_data = bytearray()
+
+    def _notify_frame(self, uuid, frame):
+        size = self.mtu - 3
+        for i in range(0, len(frame), size):
+            self._notify(uuid, frame[i:i+size])
+
+    def _notify(self, uuid, data, delay=0.0):
+        if self.loss and self._random.random() < self.loss:
+            logger.debug('SIM dropped notification: %s', data)
+            return
+        # Notifications are delivered in order, each one latency seconds after the previous
+        deliver_at = max(time.monotonic(), self._last_delivery) + self.latency + delay
+        self._last_delivery = deliver_at
+        self._queue.put_nowait((deliver_at, uuid, data))
+
+    async def _run_dispatcher(self):
+        while True:
+            deliver_at, uuid, data = await self._queue.get()
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            callback = self._callbacks.get(uuid)
+            if callback:
+                callback(uuid, data)
+
+
+class SimulatedBLEDevice(BLEDevice):
+    """Drop-in replacement for BLEDevice backed by an AsyncSimulatedBLEDevice, accepting
+    the same arguments.  Simulation attributes (firmware, ota_image, ...) are forwarded.
+    """
+
+    def __init__(self, firmware=None, runtime=None, **kwargs):
+        super().__init__(AsyncSimulatedBLEDevice(firmware, **kwargs), runtime)
+
+    def __getattr__(self, name):
+        if name in ('async_device', '_runtime'):
+            raise AttributeError(name)
+        return getattr(self.async_device, name)
@@ -24,7 +24,10 @@ setup(
         'bleak',
         'kivy',
     ],
-    extras_require={},
+    extras_require={
+        'numpy': ['numpy'],
+        'parquet': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'pylinkit = pylinkit.__main__:main'
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+from pylinkit.dte_nus import AsyncDTENUS
+from pylinkit.sim import AsyncSimulatedBLEDevice
+
+
+PARMR = '$PARMR#000;\r'
+STATR = '$STATR#000;\r'
+
+
+class LossyDevice(AsyncSimulatedBLEDevice):
+    """Drops a whole response frame or a single notification, given their (zero based)
+    indices in the order they are sent
+    """
+
+    def __init__(self, drop_frame=None, drop_notification=None, **kwargs):
+        super().__init__(**kwargs)
+        self.drop_frame = drop_frame
+        self.drop_notification = drop_notification
+        self.frames = 0
+        self.notifications = 0
+
+    def _notify_frame(self, uuid, frame):
+        self.frames += 1
+        if self.frames - 1 != self.drop_frame:
+            super()._notify_frame(uuid, frame)
+
+    def _notify(self, uuid, data, delay=0.0):
+        self.notifications += 1
+        if self.notifications - 1 != self.drop_notification:
+            super()._notify(uuid, data, delay)
+
+
+class TestLostResponseData(unittest.TestCase):
+    """A lost notification fails only the command it belongs to"""
+
+    def send_all(self, device, depth=1):
+        async def run():
+            await device.connect(device.address, 5)
+            nus = AsyncDTENUS(device, depth=depth)
+            results = []
+            for command in (PARMR, PARMR, STATR, PARMR):
+                try:
+                    frames = await nus.send(command, timeout=0.2)
+                    results.append(frames[0].cmd)
+                except Exception as e:
+                    results.append(str(e))
+            await device.disconnect()
+            return results
+        return asyncio.run(run())
+
+    def test_response_lost(self):
+        self.assertEqual(self.send_all(LossyDevice(drop_frame=0)), ['Timeout', 'PARMR', 'STATR', 'PARMR'])
+
+    def test_notification_lost_mid_response(self):
+        for depth in (1, 4):
+            self.assertEqual(self.send_all(LossyDevice(drop_notification=1), depth),
+                             ['Timeout', 'PARMR', 'STATR', 'PARMR'])
+
+
+if __name__ == '__main__':
+    unittest.main()